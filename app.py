@@ -1,5 +1,8 @@
 from tendo import singleton
 
+import argparse
+import asyncio
+import concurrent.futures
 import configparser
 import datetime
 import glob
@@ -7,7 +10,6 @@ import hashlib
 import logging
 import logging.handlers
 import os
-import random
 import shutil
 import signal
 import subprocess
@@ -16,12 +18,14 @@ import time
 
 import common.db_utils as db_utils
 import common.m3u as m3u
+import common.plan_report as plan_report
 import common.playlist_utils as playlist_utils
+import common.scheduler as scheduler
+import common.stream_metrics as stream_metrics
+import common.supervisor as supervisor
 import common.tv_maze as tv_maze
 import common.xmltv as xmltv
-
-# Throw an exception if this script is already running
-me = singleton.SingleInstance()
+import common.xmltv_shards as xmltv_shards
 
 # Default directories to use if unset in config
 DEFAULT_WORKING_DIR = '/tmp/HomeBroadcaster/'
@@ -32,14 +36,71 @@ DEFAULT_ORDER = 'Ordered'
 DEFAULT_SEGMENT_RUNTIME = 20
 DEFAULT_CHUNK_SIZE = 1
 
+# Default number of concurrent ffprobe processes if unset in config, in total and per storage device
+DEFAULT_PROBE_WORKERS = 4
+DEFAULT_PROBE_WORKERS_PER_DEVICE = 2
+
+# Default number of days before the TV Maze information of a show is refreshed if unset in config
+DEFAULT_METADATA_REFRESH_AGE = 7
+
+# Default number of shows whose episode information is loaded at the same time if unset in config
+DEFAULT_INGEST_WORKERS = 4
+
+# Number of probed episode lengths saved to the DB per transaction
+PROBE_BATCH_SIZE = 100
+
+# Default number of days before the cached length of a file which no longer exists is evicted
+DEFAULT_PROBE_CACHE_MAX_AGE = 30
+
+# Default number of hours scheduled at a time for channels in rolling mode if unset in config
+DEFAULT_ROLLING_WINDOW_HOURS = 6
+
+# Maximum number of windows chained in a single stream of a channel in rolling mode. The concat demuxer opens
+# each window inside of the previous one, so the chain is ended once it gets this long and the channel is
+# restarted on the following run
+MAX_ROLLING_WINDOWS = 120
+
+# Number of seconds finished entries are kept in the saved schedule of a channel
+SCHEDULE_KEEP_PAST = 24 * 60 * 60
+
+# Minimum number of seconds left in the saved schedule of a stopped channel for it to be resumed rather than
+# scheduled anew
+MIN_RESUME_TIME = 5 * 60
+
+# Number of seconds between the daemon checking on the channels, extending the schedules of rolling channels
+# and publishing the guide
+DAEMON_CHECK_INTERVAL = 60
+
+# Status of the stream of a channel when it is planned. A stopped channel was started before but is no longer
+# running
+CHANNEL_NOT_STARTED = 'not_started'
+CHANNEL_RUNNING = 'running'
+CHANNEL_STOPPED = 'stopped'
+
+# Change to the row of a channel in the channels table made when the channel's plan is committed
+CHANNEL_ROW_SAVE = 'save'
+CHANNEL_ROW_UPDATE = 'update'
+
+# Default number of channels planned at the same time if unset in config
+DEFAULT_PLANNING_WORKERS = 4
+
+# Number of seconds between the daemon exporting the metrics of the channel streams
+METRICS_EXPORT_INTERVAL = 10
+
 # Declare the subdirectories to be used
 logs_subdir = 'logs/'
 playlist_subdir = 'playlists/'
 pid_subdir = 'pid/'
+tv_maze_cache_subdir = 'tvmaze_cache/'
+plan_working_subdir = 'working/'
+plan_stream_subdir = 'stream/'
+guide_shards_subdir = 'guide_shards/'
+progress_subdir = 'progress/'
+metrics_subdir = 'metrics/'
 
 
 def setup_logger(log_level, log_dir):
-    log_location = log_directory + 'homeBroadcaster.log'
+    log_location = log_dir + 'homeBroadcaster.log'
     log_handler = logging.handlers.RotatingFileHandler(filename=log_location, maxBytes=10_000_000, backupCount=5)
     formatter = logging.Formatter(fmt='[%(asctime)s] %(levelname)s - %(filename)s: %(message)s')
     log_handler.setFormatter(formatter)
@@ -48,15 +109,6 @@ def setup_logger(log_level, log_dir):
     logger.setLevel(log_level)
 
 
-def check_pid_running(pid):
-    try:
-        os.kill(int(pid), 0)
-    except OSError:
-        return False
-    else:
-        return True
-
-
 def kill_running_pid(pid):
     try:
         os.kill(int(pid), signal.SIGTERM)
@@ -76,249 +128,662 @@ def clear_previous_stream_files(channel_name, stream_dir, playlist_dir):
         os.remove(file)
     if os.path.exists(playlist_dir + channel_name + ".txt"):
         os.remove(playlist_dir + channel_name + ".txt")
+    if os.path.exists(playlist_utils.get_resume_playlist_path(playlist_dir, channel_name)):
+        os.remove(playlist_utils.get_resume_playlist_path(playlist_dir, channel_name))
+    playlist_utils.remove_concat_windows(playlist_dir, channel_name)
 
 
 def populate_series_info(local_series_name, db_dir):
     db_utils.save_series(local_series_name, db_dir)
 
 
-# Given a show name, this function will populate the SQLite DB with all of the episode information
-# for that show
-def populate_tv_maze_episode_info(show_name, db_dir):
-    series_id = db_utils.get_series_id(show_name, db_dir)
-
+# Retrieves the episode list of a series from TV Maze as tuples of (season, episode, title, subtitle, description)
+def fetch_tv_maze_episodes(series_id):
     episodes_api_response = tv_maze.show_episode_list(series_id)
+    episodes = []
     for curr in episodes_api_response:
         episode_subtitle = 'S' + str(curr['season']) + 'E' + str(curr['number'])
         if not (curr['summary'] is None):
             description = curr['summary'].replace('<p>', '').replace('</p>', '').replace('<i>', '').replace('</i>', '')
         else:
             description = ''
+        episodes.append((curr['season'], curr['number'], curr['name'], episode_subtitle, description))
+    return episodes
 
-        db_utils.save_tv_maze_episode(series_id, curr['season'], curr['number'], curr['name'],
-                                      episode_subtitle, description, db_dir)
-    db_utils.populate_series_absolute_order(series_id, db_dir)
 
-
-def populate_episode_lengths(directory_full_path, show_name, db_dir):
+# Given a show name, this function will populate the SQLite DB with all of the episode information
+# for that show
+def populate_tv_maze_episode_info(show_name, db_dir):
     series_id = db_utils.get_series_id(show_name, db_dir)
-    file_list = playlist_utils.list_files_with_path(directory_full_path)
-    for file_full_path in file_list:
-        file_name = os.path.basename(file_full_path)
-        length = playlist_utils.get_video_length(file_full_path)
-        season, episode = playlist_utils.parse_season_episode(os.path.basename(file_name))
-        db_utils.save_local_episode(series_id, season, episode, length, file_full_path, db_dir)
+    episodes = fetch_tv_maze_episodes(series_id)
+
+    # Save all of the episodes for the series and number them in a single transaction
+    with db_utils.transaction(db_dir):
+        db_utils.save_tv_maze_episodes(series_id, episodes, db_dir)
+        db_utils.populate_series_absolute_order(series_id, db_dir)
 
 
-# Retrieves and loads all episode information given a source directory
-def populate_all_episode_info(show_name, directory_full_path, dirs):
+# Scans the directory of a show and loads the local file information of its episodes. Only files which are
+# new or have changed since the previous scan are probed, and episodes whose files have been removed are cleared
+def populate_episode_lengths(directory_full_path, show_name, db_dir, ingest_options):
+    series_id = db_utils.get_series_id(show_name, db_dir)
+    current_files = playlist_utils.list_files_with_stat(directory_full_path)
+    indexed_files = db_utils.get_media_file_index(series_id, db_dir)
+
+    deleted_files = [file_path for file_path in indexed_files if file_path not in current_files]
+    if deleted_files:
+        db_utils.delete_media_files(series_id, deleted_files, db_dir)
+
+    changed_files = [file_path for file_path, stat in current_files.items() if indexed_files.get(file_path) != stat]
+    if not changed_files:
+        return
+
+    # Files probed before the file index existed already have their lengths saved and only need to be indexed
+    known_lengths = db_utils.get_local_episode_lengths(series_id, db_dir)
+    already_probed = {file_path for file_path in changed_files
+                      if file_path not in indexed_files and known_lengths.get(file_path) is not None}
+    if already_probed:
+        db_utils.save_media_files(series_id, [(file_path,) + current_files[file_path] for file_path in already_probed],
+                                  db_dir)
+    files_to_probe = [file_path for file_path in changed_files if file_path not in already_probed]
+
+    # Probe the files concurrently and save the results back to the DB in batches
+    batch = []
+    for file_full_path, length in playlist_utils.probe_video_lengths(files_to_probe, ingest_options['probe_workers'],
+                                                                     ingest_options['probe_workers_per_device'],
+                                                                     db_dir):
+        season, episode = playlist_utils.parse_season_episode(os.path.basename(file_full_path))
+        batch.append((season, episode, length, file_full_path))
+        if len(batch) >= PROBE_BATCH_SIZE:
+            save_probed_episodes(series_id, batch, current_files, db_dir)
+            batch = []
+    if batch:
+        save_probed_episodes(series_id, batch, current_files, db_dir)
+
+
+def save_probed_episodes(series_id, batch, current_files, db_dir):
+    with db_utils.transaction(db_dir):
+        db_utils.save_local_episodes(series_id, batch, db_dir)
+        db_utils.save_media_files(series_id, [(file_path,) + current_files[file_path] for _, _, _, file_path in batch],
+                                  db_dir)
+
+
+# Refreshes the TV Maze information of the shows which haven't been updated in more than max_age seconds.
+# Only the episodes which changed are written, so refreshing an unchanged show costs one request
+def refresh_stale_metadata(shows, db_dir, max_age):
+    for show, series_id in db_utils.get_stale_series(max_age, shows, db_dir):
+        try:
+            changed_count = db_utils.refresh_tv_maze_episodes(series_id, fetch_tv_maze_episodes(series_id), db_dir)
+            db_utils.update_series_last_updated_time(show, db_dir)
+            logging.debug('Refreshed metadata for ' + show + ', ' + str(changed_count) + ' episodes changed')
+        except Exception:
+            logging.exception('Unable to refresh metadata for ' + show)
+
+
+# Loads the series and episode information for all shows concurrently. TV Maze requests from all shows
+# share a single rate limit while the files of the shows are probed in parallel
+def populate_all_shows(shows, dirs, ingest_options):
+
+    def populate_show(show):
+        populate_series_info(show, dirs['working_dir'])
+        populate_all_episode_info(show, shows[show], dirs, ingest_options)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ingest_options['ingest_workers']) as executor:
+        futures = [executor.submit(populate_show, show) for show in shows]
+        for future in futures:
+            future.result()
+
+
+# Retrieves and loads all episode information given a source directory. The TV Maze information is only
+# loaded once while the directory is rescanned on every run to pick up added, changed and removed files
+def populate_all_episode_info(show_name, directory_full_path, dirs, ingest_options):
     if not db_utils.is_series_metadata_loaded(show_name, dirs['working_dir']):
         populate_tv_maze_episode_info(show_name, dirs['working_dir'])
-        populate_episode_lengths(directory_full_path, show_name, dirs['working_dir'])
         db_utils.update_series_last_updated_time(show_name, dirs['working_dir'])
+    populate_episode_lengths(directory_full_path, show_name, dirs['working_dir'], ingest_options)
 
 
-def start_channel(channel_name, channel_options, shows_list, xmltv_file, dirs):
-    db_channel = db_utils.get_channel(channel_name, dirs['working_dir'])
-
-    # Generate the channel configuration hash used to determine if the channel
-    # has been updated
+# Generates the channel configuration hash used to determine if the channel has been updated
+def get_channel_config_hash(shows_list, channel_options):
     config_string = ' '.join(shows_list) + channel_options['order'] + str(channel_options['segment_runtime']) + str(channel_options['chunk_size'])
+    if channel_options['rolling']:
+        config_string = config_string + ' rolling ' + str(channel_options['rolling_window'])
     hash_object = hashlib.sha1(config_string.encode())
-    curr_config_hash = hash_object.hexdigest()
-
-    if db_channel is None:
-        shows_concat = ','.join(shows_list)
-        db_utils.save_channel(channel_name, channel_options['order'], shows_concat, curr_config_hash, dirs['working_dir'])
-        db_channel = db_utils.get_channel(channel_name, dirs['working_dir'])
-    else:
-        # Check if the channel is currently running
-        pid_file_path = dirs['pid_dir'] + channel_name + '.pid'
-        if os.path.exists(pid_file_path):
-            old_pid_file = open(pid_file_path)
-            ffmpeg_pid = old_pid_file.readline().strip()
-            old_pid_file.close()
-            if check_pid_running(ffmpeg_pid):
-                # If the channel is already running, check if the configuration of the channel
-                # has changed. If so, stop the channel and restart it with the updated configuration
-                prev_config_hash = db_utils.get_channel_config_hash(channel_name, dirs['working_dir'])
-
-                if (curr_config_hash == prev_config_hash):
-                    logging.debug(channel + ' already running, skipping...')
-                    return
-                else:
-                    logging.debug(channel + ' configuration has changed. Restarting channel...')
-                    kill_running_pid(ffmpeg_pid)
-
-                    shows_concat = ','.join(shows_list)
-                    db_utils.update_and_reset_channel(channel_name, channel_options['order'], shows_concat, curr_config_hash, dirs['working_dir'])
-                    db_channel = db_utils.get_channel(channel_name, dirs['working_dir'])
-
-                    clear_previous_stream_files(channel_name, dirs['stream_dir'], dirs['playlist_dir'])
-            else:
-                # Channel stopped running. Clear the old stream files
-                clear_previous_stream_files(channel, dirs['stream_dir'], dirs['playlist_dir'])
-
-    # Before attempting to start the channel, remove all previous programming for the channel from the
-    # XML TV file to avoid overlapping programme timings
-    xmltv.remove_channel_programmes(channel, file_xmltv)
-
-    # Retrieve the current chunk offset and previously  played chunks from the DB if the channel already exists
-    if db_channel['chunkOffset'] is None:
-        chunk_offset_list = [0] * len(shows_list)
-    else:
-        chunk_offset_list = str(db_channel['chunkOffset']).split('|')
-        chunk_offset_list = list(map(int, chunk_offset_list))
-
-    if db_channel['playedChunks'] is None:
-        previously_played_chunks = []
-        for _ in range(len(shows_list)):
-            previously_played_chunks.append([])
-    else:
-        previously_played_chunks = []
-        temp_list = []
-        prev_chunk_strings = db_channel['playedChunks'].split('|')
-        for chunk_string in prev_chunk_strings:
-            temp_list.append(chunk_string.split(','))
-        for chunk_string_list in temp_list:
-            if len(chunk_string_list) == 1 and not chunk_string_list[0]:
-                previously_played_chunks.append([])
-            else:
-                previously_played_chunks.append(list(map(int, chunk_string_list)))
-
-    shows_list = db_channel['shows'].split(',')
-    series_id_list = [None] * len(shows_list)
-
-    chunked_shows = [None] * len(shows_list)
-
-    # Retrieve all of the episodes for each show in the channel separated into chunks
-    for idx, curr_show in enumerate(shows_list):
-        curr_series_id = db_utils.get_series_id(curr_show, dirs['working_dir'])
-        series_id_list[idx] = curr_series_id
-        chunked_shows[idx] = db_utils.get_show_in_chunks(curr_series_id, chunk_offset_list[idx], channel_options['chunk_size'],
-                                                         channel_options['segment_runtime'] * 60, dirs['working_dir'])
-
-        # Remove the previously played chunks
-        temp_list = []
-        for chunk in chunked_shows[idx]:
-            if chunk[0]['absoluteOrder'] not in previously_played_chunks[idx]:
-                temp_list.append(chunk)
-        chunked_shows[idx] = temp_list
-
-    # If the ordering of the channel is set to random, shuffle the episode chunks retreived from the DB
-    if channel_options['order'] == 'Random':
-        for show_chunks in chunked_shows:
-            random.shuffle(show_chunks)
-
-    # Start adding episode chunks to the playlist until the desired end time is reached
-    # DEFAULT END TIME: 5 AM next day
-    now = datetime.datetime.now()
-    day_delta = datetime.timedelta(days=1)
-    target = now + day_delta
-    target_timestamp = target.replace(hour=5, minute=0, second=0, microsecond=0).timestamp()
-    current_timestamp = now.timestamp()
-
-    # Keep track of the chunks added to the playlist so on next playlist generation, only the unplayed chunks get
-    # added first. A chunk ID is defined as the lowest absolute order in the chunk
-    added_chunk_ids = previously_played_chunks
-
-    # Used to determine from which list of episodes chunks to add into the playlist
-    current_show_index = 0
+    return hash_object.hexdigest()
 
-    playlist = []
 
-    while current_timestamp < target_timestamp:
+# Creates the scheduler of a channel from the catalog and saved state of each show on the channel
+def create_channel_scheduler(channel_name, shows_list, channel_options, seed, show_index, db_dir):
+    # Retrieve the current chunk offset and previously played chunks from the DB if the channel already exists
+    chunk_offset_list, previously_played_chunks = db_utils.get_channel_show_state(channel_name, len(shows_list), db_dir)
 
-        # If the list of episode chunks is empty for a show, regenerate the complete set of chunks from the DB
-        if not chunked_shows[current_show_index]:
-            # Increment the chunk offset so on chunk retrieval, all of the chunks will be different than the previous grab
-            chunk_offset_list[current_show_index] = (chunk_offset_list[current_show_index] + 1) % channel_options['chunk_size']
-            chunked_shows[current_show_index] = db_utils.get_show_in_chunks(series_id_list[current_show_index],
-                                                                            chunk_offset_list[current_show_index],
-                                                                            channel_options['chunk_size'],
-                                                                            channel_options['segment_runtime'] * 60,
-                                                                            dirs['working_dir'])
-                                                                                        
-            if channel_options['order'] == 'Random':
-                random.shuffle(chunked_shows[current_show_index])
-
-            added_chunk_ids[current_show_index].clear()
-
-        chunk_to_add = chunked_shows[current_show_index][0]
-
-        playlist.extend(chunk_to_add)
-        added_chunk_ids[current_show_index].append(chunk_to_add[0]['absoluteOrder'])
-
-        # Add the runtime of the chunk to the current timestamp
-        for episode in chunk_to_add:
-            current_timestamp += episode['length']
-
-        del chunked_shows[current_show_index][0]
-
-        current_show_index = (current_show_index + 1) % len(shows_list)
+    # Retrieve the catalog of each show in the channel along with its chunks for every chunk offset the show
+    # can move to, so the schedule can be built without going back to the DB
+    show_chunks = []
+    for idx, curr_show in enumerate(shows_list):
+        curr_series_id = db_utils.get_series_id(curr_show, db_dir)
+        chunk_offsets = set(range(max(channel_options['chunk_size'], 1)))
+        chunk_offsets.add(chunk_offset_list[idx])
+        series_catalog, chunk_plans = db_utils.get_show_chunk_plans(curr_series_id, chunk_offsets,
+                                                                    channel_options['chunk_size'],
+                                                                    channel_options['segment_runtime'] * 60, db_dir)
+        show_chunks.append(scheduler.ShowChunks(series_catalog, chunk_plans, chunk_offset_list[idx],
+                                                previously_played_chunks[idx]))
+
+    return scheduler.ChannelScheduler(show_chunks, channel_options['order'], channel_options['chunk_size'], seed,
+                                      show_index)
+
+
+# Computes the chunk plans of the shows of every channel for all of the chunk offsets the shows can move to, so
+# scheduling the channels only reads plans which are already saved. Returns the number of chunk plans
+def prepare_chunk_plans(channels, db_dir):
+    chunk_parameters = set()
+    for shows_list, channel_options in channels.values():
+        for show in shows_list:
+            chunk_parameters.add((show, channel_options['chunk_size'], channel_options['segment_runtime']))
+
+    chunk_plan_count = 0
+    for show, chunk_size, segment_runtime in chunk_parameters:
+        try:
+            series_id = db_utils.get_series_id(show, db_dir)
+            _, chunk_plans = db_utils.get_show_chunk_plans(series_id, range(max(chunk_size, 1)), chunk_size,
+                                                           segment_runtime * 60, db_dir)
+        except Exception:
+            # Left for the planning of the channels with the show to report
+            continue
+        chunk_plan_count += len(chunk_plans)
+    return chunk_plan_count
+
+
+# Schedules a window of a channel and saves the chunks added to the schedule back to the DB, along with the
+# chunk offsets, so on next schedule generation only the unplayed chunks get added first. Only the changes to
+# the played chunks are saved. The window is also appended to the channel's saved schedule
+def schedule_channel(channel_name, shows_list, channel_options, seed, show_index, start_time, end_time, db_dir):
+    channel_scheduler = create_channel_scheduler(channel_name, shows_list, channel_options, seed, show_index, db_dir)
+    schedule = channel_scheduler.schedule(start_time, end_time)
+
+    schedule_entries = []
+    entry_start_time = schedule.start_time
+    for episode in schedule.entries:
+        schedule_entries.append((entry_start_time, episode.length, episode.file_path, episode.series_id,
+                                 episode.absolute_order))
+        entry_start_time = entry_start_time + episode.length
+
+    with db_utils.transaction(db_dir):
+        db_utils.update_channel_show_state(channel_name, schedule.chunk_offsets, schedule.played_chunk_ids,
+                                           schedule.cleared_shows, db_dir)
+        db_utils.append_channel_schedule(channel_name, schedule_entries, SCHEDULE_KEEP_PAST, db_dir)
+    return schedule, channel_scheduler.show_index
+
+
+# Generates a concat playlist which restarts a stopped channel where its saved schedule is at the current time,
+# seeking into the episode which should be playing so the stream matches the published guide. Returns None if
+# the saved schedule doesn't have enough left to play
+def generate_resume_playlist(channel_name, channel_options, dirs):
+    schedule_index = scheduler.ScheduleIndex(db_utils.get_channel_schedule(channel_name, dirs['working_dir']))
+    curr_time = time.time()
+    location = schedule_index.locate(curr_time)
+    if location is None or schedule_index.end_time() - curr_time < MIN_RESUME_TIME:
+        return None
+
+    start_idx, inpoint = location
+    playlist_filepaths = [entry[3] for entry in schedule_index.entries[start_idx:]]
+
+    # A channel in rolling mode carries on with the window after the last one scheduled
+    next_playlist_path = None
+    if channel_options['rolling']:
+        rolling_state = db_utils.get_channel_rolling_state(channel_name, dirs['working_dir'])
+        if rolling_state is None:
+            return None
+        if rolling_state['window_index'] + 1 < MAX_ROLLING_WINDOWS:
+            next_playlist_path = playlist_utils.get_concat_window_path(dirs['playlist_dir'], channel_name,
+                                                                       rolling_state['window_index'] + 1)
+
+    return playlist_utils.generate_resume_playlist(playlist_filepaths, inpoint, dirs['playlist_dir'], channel_name,
+                                                   next_playlist_path)
+
+
+# Adds the programmes of a schedule to a channel's guide
+def add_schedule_to_guide(channel_guide, channel_name, schedule):
+    xmltv.add_channel_if_not_exists(channel_guide, channel_name)
+    tv_guide_time = schedule.start_time
+    time_format = '%Y%m%d%H%M%S %z'
+    for episode in schedule.entries:
+        start_time = time.strftime(time_format, time.localtime(tv_guide_time))
+        stop_time = time.strftime(time_format, time.localtime(tv_guide_time + episode.length))
 
-    # Save the chunks added to the playlist back to the DB, along with the chunk offset
-    played_chunks_string_list = []
-    for chunk_list in added_chunk_ids:
-        played_chunks_string_list.append(','.join(list(map(str, chunk_list))))
-    played_chunks_string = '|'.join(list(map(str, played_chunks_string_list)))
-    chunk_offset_string = '|'.join(list(map(str, chunk_offset_list)))
-    db_utils.update_channel_chunks(channel, played_chunks_string, chunk_offset_string, dirs['working_dir'])
+        xmltv.add_programme(channel_guide, channel_name, start_time, stop_time, episode.title,
+                            episode.subtitle, episode.description)
 
-    # Generate the list of file paths for the FFMPEG playlist along with the XMLTV file
-    xmltv.add_channel_if_not_exists(xmltv_file, channel_name)
-    tv_guide_time = now.timestamp()
-    time_format = '%Y%m%d%H%M%S %z'
-    playlist_filepaths = []
-    for episode in playlist:
-        playlist_filepaths.append(episode['filePath'])
+        tv_guide_time = tv_guide_time + episode.length
 
-        start_time = time.strftime(time_format, time.localtime(tv_guide_time))
-        stop_time = time.strftime(time_format, time.localtime(tv_guide_time + episode['length']))
 
-        xmltv.add_programme(xmltv_file, channel_name, start_time, stop_time, episode['title'],
-                            episode['subtitle'], episode['description'])
+""" Extends the schedule of a channel in rolling mode until it reaches two windows past the current time.
 
-        tv_guide_time = tv_guide_time + episode['length']
+    Each window is written to its own concat playlist which the previous window's playlist ends with, so
+    the running FFMPEG process picks up the new windows without being restarted. The programmes of the new
+    windows are added to the channel's guide. Returns whether any windows were added.
+"""
+def extend_rolling_schedule(channel_name, shows_list, channel_options, config_hash, channel_guide, dirs):
+    rolling_state = db_utils.get_channel_rolling_state(channel_name, dirs['working_dir'])
+    if rolling_state is None:
+        return False
 
-    # Generate the FFMPEG concat playlist
-    concat_playlist = playlist_utils.generate_concat_playlist(playlist_filepaths, dirs['playlist_dir'], channel_name)
+    window_length = channel_options['rolling_window'] * 60 * 60
+    target_timestamp = time.time() + 2 * window_length
+    extended = False
+    while (rolling_state['schedule_end'] < target_timestamp and
+           rolling_state['window_index'] + 1 < MAX_ROLLING_WINDOWS):
+        window_index = rolling_state['window_index'] + 1
+        window_start = rolling_state['schedule_end']
+        seed = channel_name + config_hash + str(window_index)
+        schedule, show_index = schedule_channel(channel_name, shows_list, channel_options, seed,
+                                                rolling_state['show_index'], window_start,
+                                                window_start + window_length, dirs['working_dir'])
+        if not schedule.entries:
+            logging.error('No episodes to schedule for channel: ' + channel_name)
+            break
+
+        # The last window of the chain ends the stream so the channel is restarted on the next run
+        playlist_filepaths = [episode.file_path for episode in schedule.entries]
+        playlist_utils.generate_concat_window(playlist_filepaths, dirs['playlist_dir'], channel_name, window_index,
+                                              window_index + 1 < MAX_ROLLING_WINDOWS)
+        add_schedule_to_guide(channel_guide, channel_name, schedule)
+
+        rolling_state = {
+            'window_index': window_index,
+            'schedule_end': schedule.end_time,
+            'show_index': show_index
+        }
+        db_utils.save_channel_rolling_state(channel_name, window_index, schedule.end_time, show_index,
+                                            dirs['working_dir'])
+        extended = True
+
+    # The concat demuxer reads a whole playlist when it opens it, so playlists of windows which have already
+    # started playing are no longer needed
+    playlist_utils.remove_concat_windows(dirs['playlist_dir'], channel_name, rolling_state['window_index'] - 2)
+    return extended
+
+
+def get_ffmpeg_log_path(channel_name, dirs):
+    return dirs['log_dir'] + channel_name + '.ffmpeg.log'
+
+
+def get_progress_path(channel_name, dirs):
+    return dirs['progress_dir'] + channel_name + '.progress'
+
+
+# Returns the HLS playlist a channel is streamed to, which is the last argument of the channel's FFMPEG command
+def get_stream_playlist_path(channel_name, dirs):
+    return dirs['stream_dir'] + channel_name + '.m3u8'
+
+
+# Returns whether a PID is the FFMPEG process streaming a channel, so a PID reused since it was saved to the
+# channel's PID file is never taken for the channel's stream
+def is_channel_stream_pid(channel_name, pid, dirs):
+    return supervisor.is_process_running(pid, 'ffmpeg', get_stream_playlist_path(channel_name, dirs))
+
+
+# Keeps the FFMPEG log of a channel's previous stream as a backup so the reason it stopped isn't lost when the
+# stream is restarted
+def rotate_ffmpeg_log(channel_name, dirs):
+    log_path = get_ffmpeg_log_path(channel_name, dirs)
+    if os.path.exists(log_path):
+        os.replace(log_path, log_path + '.1')
+
+
+# Returns the FFMPEG command which streams a concat playlist of a channel to the channel's HLS playlist. The
+# progress of the stream is written to the progress URL, a pipe: URL of a file descriptor
+def build_ffmpeg_command(channel_name, concat_playlist, dirs, progress_url):
+    # The HLS playlist is never ended and keeps its segment numbering across restarts, while old segments are
+    # deleted as they drop out of the playlist
+    m3u8_path = get_stream_playlist_path(channel_name, dirs)
+    return [
+        "ffmpeg", "-re", "-loglevel", "warning", "-nostats", "-progress", progress_url, "-stats_period",
+        str(stream_metrics.PROGRESS_PERIOD), "-fflags", "+genpts", "-f", "concat", "-safe", "0", "-i",
+        concat_playlist, "-map", "0:a?", "-map", "0:v?", "-strict", "-2", "-dn", "-c", "copy",
+        "-hls_time", "10", "-hls_list_size", "6", "-hls_flags", "delete_segments+append_list+omit_endlist",
+        m3u8_path
+    ]
+
+
+# Starts the FFMPEG process streaming a concat playlist of a channel and saves its PID to a file which will be
+# used to determine if the channel is currently running. The progress of the stream is written to the channel's
+# progress file, which is opened in append mode so the file can be emptied while FFMPEG is writing to it
+def launch_channel_stream(channel_name, concat_playlist, dirs):
+    rotate_ffmpeg_log(channel_name, dirs)
+    progress_fd = os.open(get_progress_path(channel_name, dirs), os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND,
+                          0o644)
+    try:
+        with open(get_ffmpeg_log_path(channel_name, dirs), "w") as ffmpeg_log_file:
+            proc = subprocess.Popen(build_ffmpeg_command(channel_name, concat_playlist, dirs,
+                                                         'pipe:' + str(progress_fd)),
+                                    stderr=ffmpeg_log_file, pass_fds=(progress_fd,))
+    finally:
+        os.close(progress_fd)
 
-    # At this point, the FFMPEG playlist has been generated so the stream can be started
-    m3u8_path = dirs['stream_dir'] + channel_name + '.m3u8'
+    save_channel_pid(channel_name, proc.pid, dirs)
 
-    with open(dirs['log_dir'] + 'ffmpeg.log', "w") as ffmpeg_log_file:
-        proc = subprocess.Popen([
-            "ffmpeg", "-re", "-loglevel", "warning", "-fflags", "+genpts", "-f", "concat", "-safe", "0", "-i",
-            concat_playlist, "-map", "0:a?", "-map", "0:v?", "-strict", "-2", "-dn", "-c", "copy",
-            "-hls_time", "10", "-hls_list_size", "6", "-hls_wrap", "7", m3u8_path
-        ], stderr=ffmpeg_log_file)
 
-    # Save the PID of the FFMPEG process to a file which will be used to determine if a channel is currently running
+# Saves the PID of a channel's FFMPEG process to the channel's PID file. The file is left behind when the stream
+# exits, which is how a later run tells that the channel was started and should be resumed
+def save_channel_pid(channel_name, pid, dirs):
     pid_file = open(dirs['pid_dir'] + channel_name + ".pid", "w")
-    pid_file.write(str(proc.pid))
+    pid_file.write(str(pid))
     pid_file.close()
 
-    # Add the channel to the central streams playlist
-    if 'logo' in channel_options:
-        m3u.add_channel_with_logo(channel_name, channel_options['logo'], channel_options['domain_name'], channel_options['port'], channel_options['auth'], dirs['stream_dir'])
-    else:
-        m3u.add_channel(channel_name, channel_options['domain_name'], channel_options['port'], channel_options['auth'], dirs['stream_dir'])
 
+def remove_channel_pid_file(channel_name, dirs):
+    pid_file_path = dirs['pid_dir'] + channel_name + '.pid'
+    if os.path.exists(pid_file_path):
+        os.remove(pid_file_path)
+
+
+# Returns the status of a channel's stream from its PID file along with the PID of its FFMPEG process
+def get_channel_pid_status(channel_name, dirs):
+    pid_file_path = dirs['pid_dir'] + channel_name + '.pid'
+    if not os.path.exists(pid_file_path):
+        return CHANNEL_NOT_STARTED, None
+
+    old_pid_file = open(pid_file_path)
+    ffmpeg_pid = old_pid_file.readline().strip()
+    old_pid_file.close()
+    if is_channel_stream_pid(channel_name, ffmpeg_pid, dirs):
+        return CHANNEL_RUNNING, ffmpeg_pid
+    return CHANNEL_STOPPED, ffmpeg_pid
+
+
+""" Result of planning a channel.
+
+    Planning only writes the files and DB rows belonging to the channel itself, so channels can be planned at
+    the same time. The changes shared between channels, the channel's row in the channels table, its guide shard
+    in the manifest and its m3u entry, are kept here and applied by commit_channel_plans.
+"""
+class ChannelPlan:
+
+    def __init__(self, channel_name, channel_options, shows_list, config_hash):
+        self.channel_name = channel_name
+        self.channel_options = channel_options
+        self.shows = shows_list
+        self.config_hash = config_hash
+        self.channel_status = None
+        # CHANNEL_ROW_SAVE or CHANNEL_ROW_UPDATE if the channel's row needs writing, otherwise None
+        self.channel_row = None
+        # The guide shard written for the channel, if its guide changed
+        self.shard = None
+        # The channel's guide as it is in its shard, if the guide was read or written
+        self.guide = None
+        # The concat playlist to start the channel's stream with, or None if the stream is left as is
+        self.concat_playlist = None
+
+
+# Returns the guide of a channel from the guides kept in memory by the daemon, if given, otherwise from the
+# channel's shard
+def get_channel_guide(channel_name, guide_shards, channel_guides):
+    if channel_guides is not None and channel_name in channel_guides:
+        return channel_guides[channel_name]
+    return guide_shards.load_channel_guide(channel_name)
+
+
+# Writes the guide shard of a channel in rolling mode whose guide has been extended, dropping the programmes
+# which have already ended since the guide may have been kept in memory since they were added
+def write_rolling_guide(plan, channel_guide, guide_shards):
+    xmltv.remove_past_programmes(channel_guide)
+    plan.shard = guide_shards.write_shard(plan.channel_name + '.tv', channel_guide)
+
+
+""" Plans a channel given the status of its stream. The concat playlist of the returned plan is the playlist the
+    stream should be started with, or None if the stream is running and can be left as is.
+
+    The stop_stream function is called to stop the running stream of a channel whose configuration has
+    changed, before the channel's files are cleared. The channel guides are the guides the daemon keeps in
+    memory by channel name, which are used instead of reading the channel's guide shard.
+"""
+def plan_channel(channel_name, channel_options, shows_list, channel_status, stop_stream, guide_shards, dirs,
+                 channel_guides=None):
+    db_channel = db_utils.get_channel(channel_name, dirs['working_dir'])
 
-# -----------------SCRIPT STARTS HERE---------------------
+    curr_config_hash = get_channel_config_hash(shows_list, channel_options)
+    plan = ChannelPlan(channel_name, channel_options, shows_list, curr_config_hash)
+    plan.channel_status = channel_status
+    resume_playlist = None
 
-try:
-    config_path = sys.argv[1]
-except Exception:
-    raise Exception('No config file passed in arguments!')
+    if db_channel is None:
+        plan.channel_row = CHANNEL_ROW_SAVE
+    elif channel_status == CHANNEL_RUNNING:
+        # If the channel is already running, check if the configuration of the channel
+        # has changed. If so, stop the channel and restart it with the updated configuration
+        prev_config_hash = db_utils.get_channel_config_hash(channel_name, dirs['working_dir'])
+
+        if (curr_config_hash == prev_config_hash):
+            if channel_options['rolling']:
+                # Extend the schedule of the running channel instead of restarting it
+                shows_list = db_channel['shows'].split(',')
+                channel_guide = get_channel_guide(channel_name, guide_shards, channel_guides)
+                if extend_rolling_schedule(channel_name, shows_list, channel_options, curr_config_hash,
+                                           channel_guide, dirs):
+                    write_rolling_guide(plan, channel_guide, guide_shards)
+                plan.guide = channel_guide
+            logging.debug(channel_name + ' already running, skipping...')
+            return plan
+        else:
+            logging.debug(channel_name + ' configuration has changed. Restarting channel...')
+            stop_stream()
+
+            plan.channel_row = CHANNEL_ROW_UPDATE
+            db_utils.reset_channel_state(channel_name, dirs['working_dir'])
+
+            clear_previous_stream_files(channel_name, dirs['stream_dir'], dirs['playlist_dir'])
+    elif channel_status == CHANNEL_STOPPED:
+        # Channel stopped running. If the channel's saved schedule is still going, restart the channel
+        # from where the schedule is at instead of starting a new schedule
+        prev_config_hash = db_utils.get_channel_config_hash(channel_name, dirs['working_dir'])
+        if curr_config_hash == prev_config_hash:
+            resume_playlist = generate_resume_playlist(channel_name, channel_options, dirs)
+        else:
+            plan.channel_row = CHANNEL_ROW_UPDATE
+            db_utils.reset_channel_state(channel_name, dirs['working_dir'])
 
-try:
+        if resume_playlist is not None or (channel_options['rolling'] and curr_config_hash == prev_config_hash):
+            # The HLS playlist is kept so the restarted stream carries on its segment numbering, only
+            # the old concat playlists are cleared
+            playlist_utils.remove_concat_windows(dirs['playlist_dir'], channel_name)
+        else:
+            # Clear the old stream files
+            clear_previous_stream_files(channel_name, dirs['stream_dir'], dirs['playlist_dir'])
+    elif curr_config_hash != db_utils.get_channel_config_hash(channel_name, dirs['working_dir']):
+        # The channel was never started but its configuration has changed since it was saved
+        plan.channel_row = CHANNEL_ROW_UPDATE
+        db_utils.reset_channel_state(channel_name, dirs['working_dir'])
+
+    if plan.channel_row is None:
+        shows_list = db_channel['shows'].split(',')
+    now = datetime.datetime.now()
 
+    # The guide of a new schedule replaces all previous programming for the channel to avoid overlapping programme
+    # timings
+    channel_guide = xmltv.generate_new_xmltv()
+
+    if resume_playlist is not None:
+        logging.debug(channel_name + ' stopped running. Resuming the saved schedule...')
+        plan.concat_playlist = resume_playlist
+
+        # The channel's guide already matches the saved schedule, so it only changes if a channel in rolling
+        # mode needs more windows
+        if channel_options['rolling']:
+            channel_guide = get_channel_guide(channel_name, guide_shards, channel_guides)
+            if extend_rolling_schedule(channel_name, shows_list, channel_options, curr_config_hash, channel_guide,
+                                       dirs):
+                write_rolling_guide(plan, channel_guide, guide_shards)
+            plan.guide = channel_guide
+    elif channel_options['rolling']:
+        # Start the chain of window playlists from the current time
+        db_utils.delete_channel_schedule(channel_name, dirs['working_dir'])
+        db_utils.save_channel_rolling_state(channel_name, -1, now.timestamp(), 0, dirs['working_dir'])
+        extend_rolling_schedule(channel_name, shows_list, channel_options, curr_config_hash, channel_guide, dirs)
+        plan.concat_playlist = playlist_utils.get_concat_window_path(dirs['playlist_dir'], channel_name, 0)
+        plan.shard = guide_shards.write_shard(channel_name + '.tv', channel_guide)
+    else:
+        # Schedule episode chunks until the desired end time is reached
+        # DEFAULT END TIME: 5 AM next day
+        day_delta = datetime.timedelta(days=1)
+        target = now + day_delta
+        target_timestamp = target.replace(hour=5, minute=0, second=0, microsecond=0).timestamp()
+
+        # The random order of the channel is seeded by the channel, its configuration and the day, so the
+        # schedule of a channel can be reproduced
+        seed = channel_name + curr_config_hash + now.date().isoformat()
+        db_utils.delete_channel_schedule(channel_name, dirs['working_dir'])
+        schedule, _ = schedule_channel(channel_name, shows_list, channel_options, seed, 0, now.timestamp(),
+                                       target_timestamp, dirs['working_dir'])
+        add_schedule_to_guide(channel_guide, channel_name, schedule)
+
+        # Generate the FFMPEG concat playlist
+        playlist_filepaths = [episode.file_path for episode in schedule.entries]
+        plan.concat_playlist = playlist_utils.generate_concat_playlist(playlist_filepaths, dirs['playlist_dir'],
+                                                                       channel_name)
+
+        plan.shard = guide_shards.write_shard(channel_name + '.tv', channel_guide)
+
+    if plan.shard is not None:
+        plan.guide = channel_guide
+    return plan
+
+
+# Plans a channel run by cron, using the channel's PID file to tell if its stream is running
+def plan_cron_channel(channel_name, channel_options, shows_list, guide_shards, dirs):
+    logging.debug("Processing channel: " + channel_name)
+    channel_status, ffmpeg_pid = get_channel_pid_status(channel_name, dirs)
+    plan = plan_channel(channel_name, channel_options, shows_list, channel_status,
+                        lambda: kill_running_pid(ffmpeg_pid), guide_shards, dirs)
+    logging.debug("Finished processing channel: " + channel_name)
+    return plan
+
+
+""" Plans channels at the same time on a pool of worker threads. The plan function is called with the name of
+    each channel and returns the channel's plan.
+
+    The plans are returned in the order of the given channels. A channel which fails to plan is logged and left
+    out so it doesn't hold up the other channels.
+"""
+def plan_channels_concurrently(channel_names, plan_function, workers):
+    plans = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [(channel_name, executor.submit(plan_function, channel_name)) for channel_name in channel_names]
+        for channel_name, future in futures:
+            try:
+                plans.append(future.result())
+            except Exception:
+                logging.exception('Unable to plan channel: ' + channel_name)
+    return plans
+
+
+# Applies the changes shared between channels from their plans in one step: the rows of the channels table in a
+# single transaction, the guide shards with a single manifest write and the m3u entries of the started channels
+def commit_channel_plans(plans, guide_shards, m3u_playlist, dirs):
+    with db_utils.transaction(dirs['working_dir']):
+        for plan in plans:
+            shows_concat = ','.join(plan.shows)
+            if plan.channel_row == CHANNEL_ROW_SAVE:
+                db_utils.save_channel(plan.channel_name, plan.channel_options['order'], shows_concat,
+                                      plan.config_hash, dirs['working_dir'])
+            elif plan.channel_row == CHANNEL_ROW_UPDATE:
+                db_utils.update_channel(plan.channel_name, plan.channel_options['order'], shows_concat,
+                                        plan.config_hash, dirs['working_dir'])
+
+    guide_shards.put_shards({plan.channel_name + '.tv': plan.shard for plan in plans if plan.shard is not None})
+
+    # Add the started channels to the central streams playlist
+    for plan in plans:
+        if plan.concat_playlist is not None:
+            channel_options = plan.channel_options
+            m3u_playlist.add_channel(plan.channel_name, channel_options.get('logo'), channel_options['domain_name'],
+                                     channel_options['port'], channel_options.get('auth'))
+
+
+# Removes a channel which is no longer in the config along with all of its files, guide and saved state
+def delete_channel(channel_name, guide_shards, m3u_playlist, dirs):
+    clear_previous_stream_files(channel_name, dirs['stream_dir'], dirs['playlist_dir'])
+    guide_shards.remove_channel(channel_name)
+    m3u_playlist.remove_channel(channel_name)
+    db_utils.delete_channel(channel_name, dirs['working_dir'])
+    if os.path.exists(get_progress_path(channel_name, dirs)):
+        os.remove(get_progress_path(channel_name, dirs))
+
+
+# Reads the options of a channel from the config, falling back to the global defaults and then the built in
+# defaults for any option the channel doesn't set
+def read_channel_options(config, channel, global_defaults, auth_options, domain_name, port):
+    # Create dict to hold all options for channel creation and set default values if
+    # parameter not present in config
+    channel_opts = {}
+    if config.has_option(channel, 'Order'):
+        channel_opts['order'] = config.get(channel, 'Order')
+    else:
+        if "Order" in global_defaults:
+            channel_opts['order'] = global_defaults["Order"]
+        else:
+            channel_opts['order'] = DEFAULT_ORDER
+    if config.has_option(channel, 'Segment Runtime'):
+        channel_opts['segment_runtime'] = int(config.get(channel, 'Segment Runtime'))
+    else:
+        if "Segment Runtime" in global_defaults:
+            channel_opts['segment_runtime'] = global_defaults["Segment Runtime"]
+        else:
+            channel_opts['segment_runtime'] = DEFAULT_SEGMENT_RUNTIME
+    if config.has_option(channel, 'Chunk Size'):
+        channel_opts['chunk_size'] = int(config.get(channel, 'Chunk Size'))
+    else:
+        if "Chunk Size" in global_defaults:
+            channel_opts['chunk_size'] = global_defaults["Chunk Size"]
+        else:
+            channel_opts['chunk_size'] = DEFAULT_CHUNK_SIZE
+    if config.has_option(channel, 'Rolling'):
+        channel_opts['rolling'] = config.getboolean(channel, 'Rolling')
+    else:
+        channel_opts['rolling'] = global_defaults.get('Rolling', False)
+    if config.has_option(channel, 'Rolling Window Hours'):
+        channel_opts['rolling_window'] = config.getint(channel, 'Rolling Window Hours')
+    else:
+        channel_opts['rolling_window'] = global_defaults.get('Rolling Window Hours', DEFAULT_ROLLING_WINDOW_HOURS)
+    if config.has_option(channel, 'Logo'):
+        channel_opts['logo'] = config.get(channel, 'Logo')
+    if "Username" in auth_options and "Password" in auth_options:
+        channel_opts['auth'] = {}
+        channel_opts['auth']['username'] = auth_options['Username']
+        channel_opts['auth']['password'] = auth_options['Password']
+    channel_opts['domain_name'] = domain_name
+    channel_opts['port'] = port
+    return channel_opts
+
+
+""" Reads the config file into a dict of the settings of a run, creating any missing directories.
+
+    If a plan directory is given, the working and stream directories are pointed at subdirectories of it,
+    so a plan-only run never touches the live directories. The channels are a dict of channel name to the
+    channel's list of shows and its options, in the order they appear in the config.
+"""
+def load_settings(config_path, plan_dir=None):
     config = configparser.ConfigParser()
     config.optionxform = str
     config.read(config_path)
 
+    source_working_directory = None
+    plan_directory = None
+    if plan_dir is not None:
+        # Point the working and stream directories at the plan directory. The DB is copied over from the
+        # configured working directory once the logger is set up
+        if config.has_option('General', 'Working Directory'):
+            source_working_directory = clean_directory_path(config.get('General', 'Working Directory'))
+        else:
+            source_working_directory = DEFAULT_WORKING_DIR
+        plan_directory = clean_directory_path(plan_dir)
+        os.makedirs(plan_directory + plan_working_subdir, exist_ok=True)
+        if not config.has_section('General'):
+            config.add_section('General')
+        config.set('General', 'Working Directory', plan_directory + plan_working_subdir)
+        config.set('General', 'Stream Directory', plan_directory + plan_stream_subdir)
+
     # Check the config file for any missing directory parameters and generate the default directories if so
     if config.has_option('General', 'Working Directory'):
         working_directory = clean_directory_path(config.get('General', 'Working Directory'))
@@ -330,6 +795,7 @@ try:
     log_directory = working_directory + logs_subdir
     playlist_directory = working_directory + playlist_subdir
     pid_directory = working_directory + pid_subdir
+    progress_directory = working_directory + progress_subdir
 
     if not os.path.exists(log_directory):
         os.mkdir(log_directory)
@@ -337,6 +803,17 @@ try:
         os.mkdir(playlist_directory)
     if not os.path.exists(pid_directory):
         os.mkdir(pid_directory)
+    if not os.path.exists(progress_directory):
+        os.mkdir(progress_directory)
+
+    # The stream metrics can be written straight into the node exporter's textfile directory. A plan-only run
+    # keeps its metrics in the plan directory
+    if config.has_option('General', 'Metrics Directory') and plan_dir is None:
+        metrics_directory = clean_directory_path(config.get('General', 'Metrics Directory'))
+    else:
+        metrics_directory = working_directory + metrics_subdir
+    if not os.path.exists(metrics_directory):
+        os.mkdir(metrics_directory)
 
     # Populate stream directory and XML TV location
     if config.has_option('General', 'Stream Directory'):
@@ -346,21 +823,12 @@ try:
             os.mkdir(stream_directory)
 
         xmltv_path = stream_directory + 'xmltv.xml'
-
-        if os.path.exists(xmltv_path):
-            file_xmltv = xmltv.open_xmltv(xmltv_path)
-        else:
-            file_xmltv = xmltv.generate_new_xmltv()
     else:
         if not os.path.exists(DEFAULT_STREAM_DIR):
             os.mkdir(DEFAULT_STREAM_DIR)
         stream_directory = DEFAULT_STREAM_DIR
 
         xmltv_path = DEFAULT_STREAM_DIR + 'xmltv.xml'
-        if os.path.exists(xmltv_path):
-            file_xmltv = xmltv.open_xmltv(xmltv_path)
-        else:
-            file_xmltv = xmltv.generate_new_xmltv()
 
     # Chec kif a domain name should be used in the stream URLs
     domain_name = None
@@ -406,30 +874,187 @@ try:
         'logo_dir': logo_directory,
         'playlist_dir': playlist_directory,
         'pid_dir': pid_directory,
-        'log_dir': log_directory
+        'log_dir': log_directory,
+        'progress_dir': progress_directory,
+        'metrics_dir': metrics_directory
     }
 
-    setup_logger(logging_level, directories['log_dir'])
-    db_utils.initialize_db(directories['working_dir'])
+    # Set up the TV Maze client with a response cache in the working directory
+    tv_maze_url = None
+    if config.has_option('General', 'TV Maze URL'):
+        tv_maze_url = config.get('General', 'TV Maze URL')
+    tv_maze_cache_ttl = None
+    if config.has_option('General', 'TV Maze Cache Hours'):
+        tv_maze_cache_ttl = config.getint('General', 'TV Maze Cache Hours') * 60 * 60
+    tv_maze_cache_dir = directories['working_dir'] + tv_maze_cache_subdir
 
     # Read in any global default parameters if any and create a global default dict
     # for usage throughout the application
-    GLOBAL_DEFAULTS = {}
+    global_defaults = {}
     if config.has_section('Global Defaults'):
         if config.has_option('Global Defaults', 'Segment Runtime'):
-            GLOBAL_DEFAULTS['Segment Runtime'] = config.getint('Global Defaults', 'Segment Runtime')
+            global_defaults['Segment Runtime'] = config.getint('Global Defaults', 'Segment Runtime')
         if config.has_option('Global Defaults', 'Chunk Size'):
-            GLOBAL_DEFAULTS['Chunk Size'] = config.getint('Global Defaults', 'Chunk Size')
+            global_defaults['Chunk Size'] = config.getint('Global Defaults', 'Chunk Size')
         if config.has_option('Global Defaults', 'Order'):
-            GLOBAL_DEFAULTS['Order'] = config.get('Global Defaults', 'Order')
+            global_defaults['Order'] = config.get('Global Defaults', 'Order')
+        if config.has_option('Global Defaults', 'Rolling'):
+            global_defaults['Rolling'] = config.getboolean('Global Defaults', 'Rolling')
+        if config.has_option('Global Defaults', 'Rolling Window Hours'):
+            global_defaults['Rolling Window Hours'] = config.getint('Global Defaults', 'Rolling Window Hours')
+
+    # Read the options used when loading the episode information of the shows
+    ingest_opts = {
+        'ingest_workers': DEFAULT_INGEST_WORKERS,
+        'probe_workers': DEFAULT_PROBE_WORKERS,
+        'probe_workers_per_device': DEFAULT_PROBE_WORKERS_PER_DEVICE
+    }
+    if config.has_option('General', 'Ingest Workers'):
+        ingest_opts['ingest_workers'] = config.getint('General', 'Ingest Workers')
+    if config.has_option('General', 'Probe Workers'):
+        ingest_opts['probe_workers'] = config.getint('General', 'Probe Workers')
+    if config.has_option('General', 'Probe Workers Per Device'):
+        ingest_opts['probe_workers_per_device'] = config.getint('General', 'Probe Workers Per Device')
+    metadata_refresh_age = DEFAULT_METADATA_REFRESH_AGE
+    if config.has_option('General', 'Metadata Refresh Age'):
+        metadata_refresh_age = config.getint('General', 'Metadata Refresh Age')
+    probe_cache_max_age = DEFAULT_PROBE_CACHE_MAX_AGE
+    if config.has_option('General', 'Probe Cache Max Age'):
+        probe_cache_max_age = config.getint('General', 'Probe Cache Max Age')
+    planning_workers = DEFAULT_PLANNING_WORKERS
+    if config.has_option('General', 'Planning Workers'):
+        planning_workers = config.getint('General', 'Planning Workers')
+
+    # Read all of the channels along with the shows to be on each channel, trimming whitespaces
+    channels = {}
+    for channel in config.sections():
+        if channel == 'General' or channel == 'Shows' or channel == 'Global Defaults' or channel == 'Authentication':
+            continue
+        shows = config.get(channel, "Shows").split(',')
+        shows = [x.strip() for x in shows]
+        channels[channel] = (shows, read_channel_options(config, channel, global_defaults, auth_options, domain_name,
+                                                         port))
+
+    return {
+        'directories': directories,
+        'xmltv_path': xmltv_path,
+        'logging_level': logging_level,
+        'source_working_dir': source_working_directory,
+        'plan_dir': plan_directory,
+        'tv_maze_url': tv_maze_url,
+        'tv_maze_cache_dir': tv_maze_cache_dir,
+        'tv_maze_cache_ttl': tv_maze_cache_ttl,
+        'ingest_opts': ingest_opts,
+        'metadata_refresh_age': metadata_refresh_age,
+        'probe_cache_max_age': probe_cache_max_age,
+        'planning_workers': planning_workers,
+        'shows': dict(config.items('Shows')),
+        'channels': channels
+    }
+
+
+# Loads the series and episode information of all of the shows in the config
+def ingest_shows(settings, report):
+    directories = settings['directories']
+    with report.stage('ingest') as counts:
+        populate_all_shows(settings['shows'], directories, settings['ingest_opts'])
+        db_utils.evict_probe_cache(settings['probe_cache_max_age'] * 24 * 60 * 60, directories['working_dir'])
+        counts['shows'] = len(settings['shows'])
+        counts['episodes'], counts['local_episodes'] = db_utils.count_episodes(directories['working_dir'])
+
+
+# Refreshes any stale show information on the given executor so it doesn't hold up starting the channels
+def start_metadata_refresh(settings, refresh_executor):
+    return refresh_executor.submit(refresh_stale_metadata, list(settings['shows']),
+                                   settings['directories']['working_dir'],
+                                   settings['metadata_refresh_age'] * 24 * 60 * 60)
+
+
+# Publishes the XML TV file merged from the guide shards of all channels along with the m3u playlist
+def publish_guide_and_playlist(settings, guide_shards, m3u_playlist, report):
+    with report.stage('guide') as counts:
+        guide_shards.remove_past_programmes()
+        guide_shards.merge_to_file(settings['xmltv_path'])
+        counts['channels'] = len(guide_shards.shards)
+        counts['bytes'] = os.path.getsize(settings['xmltv_path'])
+        counts['gzip_bytes'] = os.path.getsize(settings['xmltv_path'] + '.gz')
+    with report.stage('m3u') as counts:
+        m3u_playlist.save()
+        counts['channels'] = len(m3u_playlist.entries)
+
+
+def log_below_realtime(metrics):
+    logging.warning(metrics.channel + ' is streaming at ' + str(metrics.speed) + 'x, slower than real time')
+
+
+# Exports the metrics of the channel streams from the progress files of their FFMPEG processes. Restarts are
+# carried over from the previous status file, with a restart counted whenever a stopped channel is started again
+def export_cron_metrics(plans, dirs):
+    restart_counts = stream_metrics.load_restart_counts(dirs['metrics_dir'])
+    channel_metrics = []
+    for plan in plans:
+        metrics = stream_metrics.ChannelMetrics(plan.channel_name, restart_counts.get(plan.channel_name, 0))
+        if plan.concat_playlist is not None and plan.channel_status == CHANNEL_STOPPED:
+            metrics.restarts += 1
+        metrics.running = get_channel_pid_status(plan.channel_name, dirs)[0] == CHANNEL_RUNNING
+
+        progress_path = get_progress_path(plan.channel_name, dirs)
+        if os.path.exists(progress_path):
+            progress_time = os.path.getmtime(progress_path)
+            block = stream_metrics.read_last_progress(progress_path)
+            # Only the last block is ever needed, so the file is emptied to keep it from growing for as long as
+            # the stream runs. FFMPEG appends to the file, so its next block is written from the start
+            os.truncate(progress_path, 0)
+            if block is not None:
+                metrics.update(block, progress_time)
+        if metrics.is_below_realtime():
+            log_below_realtime(metrics)
+        channel_metrics.append(metrics)
+
+    stream_metrics.save_metrics(channel_metrics, dirs['metrics_dir'])
+    return channel_metrics
+
+
+# Runs through every channel once, starting any channels that are not running. Used when the app is run by cron
+# and for plan-only runs
+def run_once(config_path, plan_dir=None):
+    report = plan_report.PlanReport()
+    settings = load_settings(config_path, plan_dir)
+    directories = settings['directories']
+
+    setup_logger(settings['logging_level'], directories['log_dir'])
+
+    if settings['source_working_dir'] is not None and os.path.exists(settings['source_working_dir'] + 'data.db'):
+        with report.stage('copy_db') as counts:
+            db_utils.backup_db(settings['source_working_dir'], directories['working_dir'])
+            counts['bytes'] = os.path.getsize(directories['working_dir'] + 'data.db')
+
+    # Seed the plan's TV Maze response cache with a copy of the live cache rather than requesting everything from
+    # TV Maze again. The live cache is only read from
+    if (settings['source_working_dir'] is not None and
+            os.path.exists(settings['source_working_dir'] + tv_maze_cache_subdir)):
+        with report.stage('copy_tv_maze_cache') as counts:
+            shutil.copytree(settings['source_working_dir'] + tv_maze_cache_subdir, settings['tv_maze_cache_dir'],
+                            ignore=shutil.ignore_patterns('*.tmp'), dirs_exist_ok=True)
+            counts['files'] = len(os.listdir(settings['tv_maze_cache_dir']))
+
+    db_utils.initialize_db(directories['working_dir'])
+    tv_maze.configure(settings['tv_maze_url'], settings['tv_maze_cache_dir'], settings['tv_maze_cache_ttl'])
 
     logging.info("Starting the Home Broadcaster application...")
 
     # Process all shows in the shows config section
-    input_shows = dict(config.items('Shows'))
-    for show in input_shows:
-        populate_series_info(show, directories['working_dir'])
-        populate_all_episode_info(show, input_shows[show], directories)
+    ingest_shows(settings, report)
+
+    refresh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    refresh_future = start_metadata_refresh(settings, refresh_executor)
+
+    # Load the per channel guide shards, splitting up the existing XML TV file the first time
+    guide_shards = xmltv_shards.GuideShards.load(directories['working_dir'] + guide_shards_subdir,
+                                                 settings['xmltv_path'])
+
+    # Load the parent m3u playlist. All of the changes to it are written once at the end of the run
+    m3u_playlist = m3u.Playlist.load(m3u.get_m3u_path(directories['stream_dir']))
 
     # Stop and delete channels that have been removed from the config
     pid_files = playlist_utils.list_files_with_path(directories['pid_dir'])
@@ -437,83 +1062,371 @@ try:
 
         pid_channel_name = os.path.basename(pid_file_path).replace(".pid", "")
 
-        if not config.has_section(pid_channel_name):
+        if pid_channel_name not in settings['channels']:
             old_pid_file = open(pid_file_path)
             pid = old_pid_file.readline().strip()
             old_pid_file.close()
 
-            clear_previous_stream_files(pid_channel_name, directories['stream_dir'], directories['playlist_dir'])
-            xmltv.remove_channel(pid_channel_name, file_xmltv)
-            xmltv.remove_channel_programmes(pid_channel_name, file_xmltv)
-            m3u.remove_channel(pid_channel_name, directories['stream_dir'])
-            db_utils.delete_channel(pid_channel_name, directories['working_dir'])
+            delete_channel(pid_channel_name, guide_shards, m3u_playlist, directories)
 
-            if check_pid_running(pid):
+            if is_channel_stream_pid(pid_channel_name, pid, directories):
                 logging.debug("Channel currently running but not in config. Stopping channel: " + pid_channel_name)
                 kill_running_pid(pid)
             os.remove(pid_file_path)
 
-    # Generate the parent m3u file if not exists
-    m3u_path = directories['stream_dir']
-    if not m3u_path.endswith('/'):
-        m3u_path = m3u_path + '/'
-    m3u_path = m3u_path + "tv.m3u"
-    m3u.generate_m3u_if_not_exists(m3u_path)
+    def plan_function(channel):
+        shows, channel_opts = settings['channels'][channel]
+        return plan_cron_channel(channel, channel_opts, shows, guide_shards, directories)
+
+    with report.stage('chunking') as counts:
+        counts['chunk_plans'] = prepare_chunk_plans(settings['channels'], directories['working_dir'])
+
+    # Plan all of the channels at the same time, then apply their shared changes in one step. Planning a channel
+    # covers scheduling it along with writing its guide shard and concat playlists
+    with report.stage('scheduling') as schedule_counts:
+        plans = plan_channels_concurrently(settings['channels'], plan_function, settings['planning_workers'])
+        schedule_counts['channels'] = len(plans)
+    # Counted outside of the stage so the count isn't part of its time
+    schedule_counts['schedule_entries'] = db_utils.count_schedule_entries(directories['working_dir'])
+    with report.stage('commit') as counts:
+        commit_channel_plans(plans, guide_shards, m3u_playlist, directories)
+        counts['channels'] = len(plans)
 
     # Start any channels that are currently not running
-    for channel in config.sections():
-        if channel == 'General' or channel == 'Shows' or channel == 'Global Defaults' or channel == 'Authentication':
-            continue
+    if plan_dir is None:
+        with report.stage('launch') as counts:
+            counts['started'] = 0
+            for plan in plans:
+                if plan.concat_playlist is not None:
+                    launch_channel_stream(plan.channel_name, plan.concat_playlist, directories)
+                    counts['started'] += 1
+
+        with report.stage('metrics') as counts:
+            channel_metrics = export_cron_metrics(plans, directories)
+            counts['channels'] = len(channel_metrics)
+            counts['below_realtime'] = sum(1 for metrics in channel_metrics if metrics.is_below_realtime())
+
+    publish_guide_and_playlist(settings, guide_shards, m3u_playlist, report)
+
+    with report.stage('metadata_refresh'):
+        refresh_future.result()
+        refresh_executor.shutdown()
+
+    if plan_dir is not None:
+        report.save(settings['plan_dir'] + 'plan_report.json')
+        print(report.render())
+    logging.info("Run stage timings:\n" + report.render())
 
-        logging.debug("Processing channel: " + channel)
+    logging.info("Application has finished running. Exiting...")
 
-        # Read all of the shows to be on the channel and trim whitespaces
-        shows = config.get(channel, "Shows").split(',')
-        shows = [x.strip() for x in shows]
 
-        # Create dict to hold all options for channel creation and set default values if
-        # parameter not present in config
-        channel_opts = {}
-        if config.has_option(channel, 'Order'):
-            channel_opts['order'] = config.get(channel, 'Order')
-        else:
-            if "Order" in GLOBAL_DEFAULTS:
-                channel_opts['order'] = GLOBAL_DEFAULTS["Order"]
-            else:
-                channel_opts['order'] = DEFAULT_ORDER
-        if config.has_option(channel, 'Segment Runtime'):
-            channel_opts['segment_runtime'] = int(config.get(channel, 'Segment Runtime'))
-        else:
-            if "Segment Runtime" in GLOBAL_DEFAULTS:
-                channel_opts['segment_runtime'] = GLOBAL_DEFAULTS["Segment Runtime"]
-            else:
-                channel_opts['segment_runtime'] = DEFAULT_SEGMENT_RUNTIME
-        if config.has_option(channel, 'Chunk Size'):
-            channel_opts['chunk_size'] = int(config.get(channel, 'Chunk Size'))
-        else:
-            if "Chunk Size" in GLOBAL_DEFAULTS:
-                channel_opts['chunk_size'] = GLOBAL_DEFAULTS["Chunk Size"]
-            else:
-                channel_opts['chunk_size'] = DEFAULT_CHUNK_SIZE
-        if config.has_option(channel, 'Logo'):
-            channel_opts['logo'] = config.get(channel, 'Logo')
-        if "Username" in auth_options and "Password" in auth_options:
-            channel_opts['auth'] = {}
-            channel_opts['auth']['username'] = auth_options['Username']
-            channel_opts['auth']['password'] = auth_options['Password']
-        channel_opts['domain_name'] = domain_name
-        channel_opts['port'] = port
-
-        start_channel(channel, channel_opts, shows, file_xmltv, directories)
-
-        logging.debug("Finished processing channel: " + channel)
-
-    xmltv.remove_past_programmes(file_xmltv)
-    xmltv.save_to_file(file_xmltv, xmltv_path)
+""" Long-running mode of the app which supervises the streams of all channels.
+
+    The settings, guide shards and m3u playlist are loaded once and kept in memory, and the FFMPEG process of
+    each channel is a child of the daemon. A channel whose stream exits is resumed within seconds instead of
+    on the next cron run, rolling channels are extended as they go and the config is reloaded on SIGHUP.
+
+    Planning is driven from a single planner thread, which plans the channels on a pool of workers and applies
+    their shared changes itself, so the guide shards and m3u playlist are only ever changed from one thread.
+    The event loop looks after the child processes and signals.
+"""
+class BroadcastDaemon:
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.settings = None
+        self.guide_shards = None
+        self.m3u_playlist = None
+        self.supervisor = supervisor.Supervisor(self.restart_channel)
+        self.planner = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.refresh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Channels whose streams were started before the daemon took over, which are resumed rather than
+        # scheduled anew
+        self.stopped_channels = set()
+        # Channel name to the metrics of the channel's stream and the parser of its progress output
+        self.channel_metrics = {}
+        self.progress_parsers = {}
+        # Restart counts of the channels saved by the previous run
+        self.restart_counts = {}
+        # Channels last seen streaming slower than real time
+        self.slow_channels = set()
+        # Channel name to the channel's guide as last written to its shard, so the guides of rolling channels
+        # aren't read back from their shards every time they are extended
+        self.channel_guides = {}
+        self.loop = None
+        self.wake_event = None
+        self.reload_requested = False
+        self.stop_requested = False
+
+    async def run_in_planner(self, function, *args):
+        return await self.loop.run_in_executor(self.planner, function, *args)
+
+    # Runs a coroutine on the event loop from the planner thread and waits for its result
+    def call_on_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request_reload(self):
+        self.reload_requested = True
+        self.wake_event.set()
+
+    def request_stop(self):
+        self.stop_requested = True
+        self.wake_event.set()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake_event = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+        self.loop.add_signal_handler(signal.SIGTERM, self.request_stop)
+        self.loop.add_signal_handler(signal.SIGINT, self.request_stop)
+
+        export_task = None
+        try:
+            await self.run_in_planner(self.load)
+            await self.reconcile_channels()
+            export_task = asyncio.ensure_future(self.export_metrics_periodically())
+
+            while not self.stop_requested:
+                try:
+                    await asyncio.wait_for(self.wake_event.wait(), DAEMON_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wake_event.clear()
+                if self.stop_requested:
+                    break
+
+                try:
+                    if self.reload_requested:
+                        self.reload_requested = False
+                        logging.info('Reloading the config...')
+                        await self.run_in_planner(self.reload)
+                    await self.reconcile_channels()
+                except Exception:
+                    logging.exception('Error occurred while checking the channels')
+        finally:
+            logging.info('Stopping all channels...')
+            if export_task is not None:
+                export_task.cancel()
+            await self.supervisor.stop_all()
+            # Export once more so the last saved metrics show the channels as stopped and keep their restart counts
+            if self.settings is not None:
+                try:
+                    self.export_metrics()
+                except Exception:
+                    logging.exception('Unable to export the stream metrics')
+            await self.run_in_planner(db_utils.close_db)
+            self.planner.shutdown()
+            self.refresh_executor.shutdown()
+
+    # Loads the settings, shows and guide. Streams left running by the cron-run script, or by a previous daemon
+    # which didn't get to stop them, are stopped and their PID files removed, and the channels are resumed as
+    # children of the daemon
+    def load(self):
+        self.settings = load_settings(self.config_path)
+        directories = self.settings['directories']
+        setup_logger(self.settings['logging_level'], directories['log_dir'])
+        logging.info("Starting the Home Broadcaster daemon...")
+
+        db_utils.initialize_db(directories['working_dir'])
+        tv_maze.configure(self.settings['tv_maze_url'], self.settings['tv_maze_cache_dir'],
+                          self.settings['tv_maze_cache_ttl'])
+
+        for pid_file_path in playlist_utils.list_files_with_path(directories['pid_dir']):
+            channel_name = os.path.basename(pid_file_path).replace(".pid", "")
+            if supervisor.stop_pid_file_process(pid_file_path, 'ffmpeg',
+                                                get_stream_playlist_path(channel_name, directories)):
+                logging.debug('Took over channel: ' + channel_name)
+            self.stopped_channels.add(channel_name)
+
+        ingest_shows(self.settings, plan_report.PlanReport())
+        start_metadata_refresh(self.settings, self.refresh_executor)
+
+        self.guide_shards = xmltv_shards.GuideShards.load(directories['working_dir'] + guide_shards_subdir,
+                                                          self.settings['xmltv_path'])
+        self.m3u_playlist = m3u.Playlist.load(m3u.get_m3u_path(directories['stream_dir']))
+        self.restart_counts = stream_metrics.load_restart_counts(directories['metrics_dir'])
+
+    # Reloads the config and the shows. The directories are kept, since the guide, playlists and streams of
+    # the running channels live in them, and changing them needs a restart of the daemon
+    def reload(self):
+        settings = load_settings(self.config_path)
+        if settings['directories'] != self.settings['directories']:
+            logging.warning('The directories can only be changed by restarting the daemon, keeping the current '
+                            'directories')
+            settings['directories'] = self.settings['directories']
+            settings['xmltv_path'] = self.settings['xmltv_path']
+        logging.getLogger().setLevel(settings['logging_level'])
+        tv_maze.configure(settings['tv_maze_url'], settings['tv_maze_cache_dir'], settings['tv_maze_cache_ttl'])
+        self.settings = settings
+
+        ingest_shows(self.settings, plan_report.PlanReport())
+        start_metadata_refresh(self.settings, self.refresh_executor)
+
+    # Returns the status of a channel's stream as seen by the supervisor
+    def get_channel_status(self, channel_name):
+        state = self.supervisor.get_state(channel_name)
+        if state is not None and state != supervisor.STATE_STOPPED:
+            # A channel waiting to be restarted is left to the supervisor
+            return CHANNEL_RUNNING
+        if channel_name in self.stopped_channels:
+            return CHANNEL_STOPPED
+        return CHANNEL_NOT_STARTED
+
+    # Plans a channel, stopping its stream through the supervisor if it needs restarting
+    def plan_daemon_channel(self, channel_name, channel_status):
+        shows, channel_opts = self.settings['channels'][channel_name]
+        return plan_channel(channel_name, channel_opts, shows, channel_status,
+                            lambda: self.call_on_loop(self.supervisor.stop(channel_name)), self.guide_shards,
+                            self.settings['directories'], self.channel_guides)
+
+    # Applies the shared changes of the plans and keeps the guides written for the channels in memory
+    def commit_plans(self, plans):
+        commit_channel_plans(plans, self.guide_shards, self.m3u_playlist, self.settings['directories'])
+        for plan in plans:
+            if plan.guide is not None:
+                self.channel_guides[plan.channel_name] = plan.guide
+
+    # Removes the channels which are no longer in the config, plans the rest and publishes the guide and m3u
+    # playlist. Returns the channels to start along with their concat playlists
+    def plan_channels(self):
+        report = plan_report.PlanReport()
+        directories = self.settings['directories']
+        for channel_name in set(self.supervisor.names()) | self.stopped_channels:
+            if channel_name not in self.settings['channels']:
+                logging.debug("Channel not in config. Stopping channel: " + channel_name)
+                self.call_on_loop(self.supervisor.stop(channel_name))
+                self.stopped_channels.discard(channel_name)
+                self.channel_guides.pop(channel_name, None)
+                delete_channel(channel_name, self.guide_shards, self.m3u_playlist, directories)
+                remove_channel_pid_file(channel_name, directories)
+
+        # The statuses are read up front so every channel is planned against the same view of the supervisor
+        channel_statuses = {channel_name: self.get_channel_status(channel_name)
+                            for channel_name in self.settings['channels']}
+        with report.stage('channels') as counts:
+            plans = plan_channels_concurrently(
+                channel_statuses, lambda channel_name: self.plan_daemon_channel(channel_name,
+                                                                                channel_statuses[channel_name]),
+                self.settings['planning_workers'])
+            counts['channels'] = len(plans)
+        with report.stage('commit') as counts:
+            self.commit_plans(plans)
+            counts['channels'] = len(plans)
+
+        launches = [(plan.channel_name, plan.concat_playlist) for plan in plans if plan.concat_playlist is not None]
+
+        publish_guide_and_playlist(self.settings, self.guide_shards, self.m3u_playlist, report)
+        logging.debug("Channel check stage timings:\n" + report.render())
+        return launches
+
+    async def reconcile_channels(self):
+        for channel_name, concat_playlist in await self.run_in_planner(self.plan_channels):
+            await self.launch_channel(channel_name, concat_playlist)
+
+    # Starts the stream of a channel with its progress written to the daemon through a pipe. The PID of the
+    # stream is saved to the channel's PID file like the cron-run script does, so if the daemon dies without
+    # stopping its children, the next run finds the stream and stops it before resuming the channel
+    async def launch_channel(self, channel_name, concat_playlist):
+        directories = self.settings['directories']
+        if channel_name not in self.channel_metrics:
+            self.channel_metrics[channel_name] = stream_metrics.ChannelMetrics(
+                channel_name, self.restart_counts.get(channel_name, 0))
+        self.progress_parsers[channel_name] = stream_metrics.ProgressParser()
+
+        rotate_ffmpeg_log(channel_name, directories)
+        await self.supervisor.start(channel_name,
+                                    build_ffmpeg_command(channel_name, concat_playlist, directories, 'pipe:1'),
+                                    get_ffmpeg_log_path(channel_name, directories), self.handle_progress_line)
+        save_channel_pid(channel_name, self.supervisor.get_pid(channel_name), directories)
+        self.stopped_channels.discard(channel_name)
+
+    def handle_progress_line(self, channel_name, line):
+        parser = self.progress_parsers.get(channel_name)
+        if parser is None:
+            return
+        block = parser.feed(line)
+        if block is not None and channel_name in self.channel_metrics:
+            self.channel_metrics[channel_name].update(block, time.time())
+
+    # Writes the metrics of the streams of the channels in the config, logging channels as they fall behind
+    # real time
+    def export_metrics(self):
+        for channel_name in list(self.channel_metrics):
+            if channel_name not in self.settings['channels']:
+                del self.channel_metrics[channel_name]
+                self.progress_parsers.pop(channel_name, None)
+                self.slow_channels.discard(channel_name)
+
+        channel_metrics = []
+        for channel_name in self.settings['channels']:
+            metrics = self.channel_metrics.get(channel_name)
+            if metrics is None:
+                metrics = stream_metrics.ChannelMetrics(channel_name, self.restart_counts.get(channel_name, 0))
+            metrics.running = self.supervisor.is_running(channel_name)
+            if metrics.is_below_realtime() and channel_name not in self.slow_channels:
+                log_below_realtime(metrics)
+                self.slow_channels.add(channel_name)
+            elif not metrics.is_below_realtime():
+                self.slow_channels.discard(channel_name)
+            channel_metrics.append(metrics)
+        stream_metrics.save_metrics(channel_metrics, self.settings['directories']['metrics_dir'])
+
+    async def export_metrics_periodically(self):
+        while True:
+            try:
+                self.export_metrics()
+            except Exception:
+                logging.exception('Unable to export the stream metrics')
+            await asyncio.sleep(METRICS_EXPORT_INTERVAL)
+
+    # Plans a channel whose stream exited so it resumes where its schedule is at
+    def plan_restart(self, channel_name):
+        if channel_name not in self.settings['channels']:
+            return None
+        plan = self.plan_daemon_channel(channel_name, CHANNEL_STOPPED)
+        self.commit_plans([plan])
+        publish_guide_and_playlist(self.settings, self.guide_shards, self.m3u_playlist, plan_report.PlanReport())
+        return plan.concat_playlist
+
+    # Called by the supervisor when the stream of a channel exits on its own
+    async def restart_channel(self, channel_name):
+        concat_playlist = await self.run_in_planner(self.plan_restart, channel_name)
+        if concat_playlist is None:
+            await self.supervisor.stop(channel_name)
+            remove_channel_pid_file(channel_name, self.settings['directories'])
+            return
+        logging.info('Restarting channel: ' + channel_name)
+        await self.launch_channel(channel_name, concat_playlist)
+        self.channel_metrics[channel_name].restarts += 1
 
-    logging.info("Application has finished running. Exiting...")
 
+# -----------------SCRIPT STARTS HERE---------------------
+
+arg_parser = argparse.ArgumentParser(description='Home Broadcaster')
+arg_parser.add_argument('config_path', help='path to the config file')
+arg_parser.add_argument('--plan-only', metavar='DIR', dest='plan_dir',
+                        help='build the schedules, guide and playlist into DIR using a copy of the DB, without '
+                             'starting or stopping any streams, and report how long each stage took')
+arg_parser.add_argument('--daemon', action='store_true',
+                        help='keep running and supervise the streams of all channels, restarting any stream which '
+                             'exits. Send SIGHUP to reload the config')
+args = arg_parser.parse_args()
+if args.plan_dir is not None and args.daemon:
+    arg_parser.error('--plan-only and --daemon cannot be used together')
+
+# Throw an exception if this script is already running. A plan-only run doesn't touch the live directories so it
+# may run alongside
+if args.plan_dir is None:
+    me = singleton.SingleInstance()
+
+try:
+    if args.daemon:
+        asyncio.run(BroadcastDaemon(args.config_path).run())
+    else:
+        run_once(args.config_path, args.plan_dir)
 except Exception as err:
     logging.exception("Error occurred in script")
+finally:
+    db_utils.close_db()
 
 sys.exit()
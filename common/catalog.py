@@ -0,0 +1,179 @@
+from array import array
+import mmap
+import os
+import struct
+
+import common.file_utils as file_utils
+
+# Compact, read only view of the episodes of a series used for channel planning. Numeric columns are kept
+# in arrays and text columns in a single encoded blob per column, so a catalog costs a few bytes per episode
+# instead of one dict per episode. Descriptions are not kept at all and are only loaded when requested.
+#
+# A catalog can be exported to a snapshot file which is memory-mapped when loaded, so loading a snapshot
+# takes the same time no matter how many episodes the series has.
+
+SNAPSHOT_MAGIC = b'TBCAT001'
+
+# Magic, series ID, episodes version, episode count
+SNAPSHOT_HEADER = struct.Struct('<8sqqq')
+
+TEXT_COLUMNS = ('title', 'subtitle', 'file_path')
+
+
+class Episode:
+    __slots__ = ('series_id', 'absolute_order', 'season', 'episode', 'title', 'subtitle', 'length', 'file_path',
+                 '_catalog', '_index')
+
+    def __init__(self, catalog, index):
+        self.series_id = catalog.series_id
+        self.absolute_order = catalog.absolute_orders[index]
+        self.season = catalog.seasons[index]
+        self.episode = catalog.episode_numbers[index]
+        self.title = catalog.text('title', index)
+        self.subtitle = catalog.text('subtitle', index)
+        self.length = catalog.lengths[index]
+        self.file_path = catalog.text('file_path', index)
+        self._catalog = catalog
+        self._index = index
+
+    @property
+    def description(self):
+        return self._catalog.description(self._index)
+
+
+class Catalog:
+
+    """ The numeric columns can be any sequence type, either arrays when built from DB rows or memoryviews
+        over the snapshot file when loaded from a snapshot. The text columns are a dict of column name to
+        (offsets, blob) where the text for episode i is blob[offsets[i]:offsets[i + 1]] encoded as UTF-8.
+        The description loader is called with (series_id, absolute_order) to retrieve a description.
+    """
+    def __init__(self, series_id, absolute_orders, seasons, episode_numbers, lengths, offsets, text_columns,
+                 description_loader):
+        self.series_id = series_id
+        self.absolute_orders = absolute_orders
+        self.seasons = seasons
+        self.episode_numbers = episode_numbers
+        self.lengths = lengths
+        self.offsets = offsets
+        self.text_columns = text_columns
+        self.description_loader = description_loader
+
+    # Builds a catalog from rows of (absolute_order, season, episode, title, subtitle, length, file_path)
+    # sorted by absolute order
+    @classmethod
+    def from_rows(cls, series_id, rows, description_loader):
+        absolute_orders = array('q')
+        seasons = array('q')
+        episode_numbers = array('q')
+        lengths = array('d')
+        offsets = array('d', [0.0])
+        texts = {column: [] for column in TEXT_COLUMNS}
+        for row in rows:
+            absolute_orders.append(row[0])
+            seasons.append(row[1])
+            episode_numbers.append(row[2])
+            texts['title'].append(row[3])
+            texts['subtitle'].append(row[4])
+            lengths.append(row[5])
+            offsets.append(offsets[-1] + row[5])
+            texts['file_path'].append(row[6])
+
+        text_columns = {column: encode_text_column(values) for column, values in texts.items()}
+        return cls(series_id, absolute_orders, seasons, episode_numbers, lengths, offsets, text_columns, description_loader)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('catalog index out of range')
+        return Episode(self, index)
+
+    # Returns the episode records for the given index range
+    def slice(self, start, end):
+        return [Episode(self, index) for index in range(start, end)]
+
+    def text(self, column, index):
+        offsets, blob = self.text_columns[column]
+        return bytes(blob[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def description(self, index):
+        return self.description_loader(self.series_id, self.absolute_orders[index])
+
+
+# Encodes a list of strings into (offsets, blob). Missing values are stored as empty strings
+def encode_text_column(values):
+    offsets = array('q', [0])
+    encoded = []
+    for value in values:
+        value_bytes = (value or '').encode('utf-8')
+        encoded.append(value_bytes)
+        offsets.append(offsets[-1] + len(value_bytes))
+    return offsets, b''.join(encoded)
+
+
+""" Writes a catalog to a snapshot file.
+
+    Layout after the header: absolute orders, seasons, episode numbers (int64), lengths (float64),
+    start offsets (float64, one extra for the total runtime), the offsets of each text column (int64) and
+    finally the text blobs. Arrays are written in the machine's native byte order. The file is written to a
+    temporary path and renamed so a reader never maps a partially written snapshot.
+"""
+def save_snapshot(catalog, path, episodes_version):
+    def write_snapshot(f):
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, catalog.series_id, episodes_version, len(catalog)))
+        numeric_columns = [(catalog.absolute_orders, 'q'), (catalog.seasons, 'q'), (catalog.episode_numbers, 'q'),
+                           (catalog.lengths, 'd'), (catalog.offsets, 'd')]
+        for column, typecode in numeric_columns:
+            f.write(array(typecode, column).tobytes())
+        for column in TEXT_COLUMNS:
+            f.write(array('q', catalog.text_columns[column][0]).tobytes())
+        for column in TEXT_COLUMNS:
+            f.write(bytes(catalog.text_columns[column][1]))
+
+    file_utils.write_atomically(path, write_snapshot)
+
+
+# Loads a snapshot file. None is returned if the snapshot doesn't exist or was written for a different
+# version of the series' episodes
+def load_snapshot(path, series_id, episodes_version, description_loader):
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, snapshot_series_id, snapshot_version, count = SNAPSHOT_HEADER.unpack_from(mapped)
+    if magic != SNAPSHOT_MAGIC or snapshot_series_id != series_id or snapshot_version != episodes_version:
+        mapped.close()
+        return None
+
+    view = memoryview(mapped)
+    position = SNAPSHOT_HEADER.size
+
+    def take(typecode, length):
+        nonlocal position
+        size = length * 8
+        column = view[position:position + size].cast(typecode)
+        position += size
+        return column
+
+    absolute_orders = take('q', count)
+    seasons = take('q', count)
+    episode_numbers = take('q', count)
+    lengths = take('d', count)
+    offsets = take('d', count + 1)
+    text_offsets = [take('q', count + 1) for _ in TEXT_COLUMNS]
+
+    text_columns = {}
+    for column, column_offsets in zip(TEXT_COLUMNS, text_offsets):
+        blob_size = column_offsets[count]
+        text_columns[column] = (column_offsets, view[position:position + blob_size])
+        position += blob_size
+
+    return Catalog(series_id, absolute_orders, seasons, episode_numbers, lengths, offsets, text_columns, description_loader)
@@ -0,0 +1,99 @@
+from bisect import bisect_left
+from itertools import accumulate
+import sys
+
+# Chunking engine used to split a series' episodes into segments and chunks. See get_show_chunk_plans in
+# db_utils for the definitions of a segment and a chunk.
+#
+# All of the functions in this module work on a list of episode lengths in airing order and return
+# (start, end) index ranges into that list rather than copies of the episodes themselves.
+
+
+# Returns the cumulative runtime before each episode, with the total runtime as the last element
+def build_prefix_sums(lengths):
+    return list(accumulate(lengths, initial=0))
+
+
+# Returns the largest possible difference between a runtime taken from the prefix sums and the same
+# runtime accumulated one episode at a time
+def rounding_tolerance(prefix_sums):
+    return 4 * len(prefix_sums) * abs(prefix_sums[-1]) * sys.float_info.epsilon
+
+
+# Returns the index one past the last episode of the segment starting at the given index, or None if the
+# remaining episodes are not long enough to complete a segment
+def find_segment_end(lengths, prefix_sums, start, segment_runtime, tolerance):
+    episode_count = len(lengths)
+    segment_base = prefix_sums[start]
+    if prefix_sums[episode_count] - segment_base < segment_runtime - tolerance:
+        return None
+
+    end = bisect_left(prefix_sums, segment_base + segment_runtime, start + 1, episode_count + 1)
+    end = min(end, episode_count)
+    if (prefix_sums[end] - segment_base >= segment_runtime + tolerance and
+            (end == start + 1 or prefix_sums[end - 1] - segment_base < segment_runtime - tolerance)):
+        return end
+
+    # The boundary is close enough to the segment runtime that the rounding of the prefix sums could move it
+    # by an episode. Confirm it against the running total of the segment itself
+    running_totals = list(accumulate(lengths[start:end]))
+    while end > start + 1 and running_totals[end - start - 2] >= segment_runtime:
+        end -= 1
+    if running_totals[end - start - 1] >= segment_runtime:
+        return end
+
+    running_total = running_totals[-1]
+    while end < episode_count:
+        running_total += lengths[end]
+        end += 1
+        if running_total >= segment_runtime:
+            return end
+    return None
+
+
+""" Splits a list of episode lengths into chunks and returns the index range of each chunk.
+
+    If a non-zero chunk offset is given, the episodes before the offset make up the first chunk. Any
+    segment or chunk left incomplete by the last episodes is returned as the final chunk. The prefix sums
+    of the lengths can be passed in if they have already been computed. A series without any episodes has
+    no chunks.
+"""
+def chunk_ranges(lengths, chunk_offset, segments_per_chunk, segment_runtime, prefix_sums=None):
+    episode_count = len(lengths)
+    ranges = []
+
+    start = min(chunk_offset, episode_count)
+    if start != 0:
+        ranges.append((0, start))
+    if start == episode_count:
+        return ranges
+
+    # When every remaining episode completes a segment on its own, each chunk is simply a fixed number of
+    # episodes so no searching is needed
+    if min(lengths[start:]) >= segment_runtime:
+        step = max(segments_per_chunk, 1)
+        ranges.extend((chunk_start, min(chunk_start + step, episode_count))
+                      for chunk_start in range(start, episode_count, step))
+        return ranges
+
+    if prefix_sums is None:
+        prefix_sums = build_prefix_sums(lengths)
+    tolerance = rounding_tolerance(prefix_sums)
+    chunk_start = start
+    segment_count = 0
+    while start < episode_count:
+        segment_end = find_segment_end(lengths, prefix_sums, start, segment_runtime, tolerance)
+        if segment_end is None:
+            break
+        start = segment_end
+        segment_count += 1
+        if segment_count >= segments_per_chunk:
+            ranges.append((chunk_start, start))
+            chunk_start = start
+            segment_count = 0
+
+    # Add any partial chunk or segment which may have been generated at the end
+    if chunk_start < episode_count:
+        ranges.append((chunk_start, episode_count))
+
+    return ranges
@@ -1,14 +1,147 @@
+import common.catalog as catalog
+import common.chunking as chunking
 import common.tv_maze as tv_maze
 
+from contextlib import contextmanager
+import functools
+import json
+import os
 import sqlite3
+import threading
 import time
+import urllib.parse
 
+# Pragmas applied to every connection when it is first opened. WAL lets readers and the single writer run
+# without blocking each other and NORMAL sync only fsyncs at checkpoints instead of on every commit
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA busy_timeout = 10000'
+]
+
+# Subdirectory of the DB directory where the series catalog snapshots are saved
+CATALOG_SUBDIR = 'catalog/'
+
+# Minimum number of seconds between updates of the last seen time of a probe cache entry
+PROBE_CACHE_TOUCH_INTERVAL = 24 * 60 * 60
+
+# Connections are kept open for the lifetime of the run and are never shared between threads. Each
+# worker thread lazily opens its own connection to the DB on first use
+_local = threading.local()
+
+# Catalogs already loaded by this process keyed by DB directory and series ID, along with the episodes version
+# they were built from. Catalogs are never changed once built so they are shared between threads, which lets a
+# long-running process reuse them until the episodes of the series change
+_catalog_cache = {}
 
-def connect_db(db_dir):
-    return sqlite3.connect(db_dir + 'data.db')
 
+def _thread_state():
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+        _local.transaction_depth = {}
+    return _local
 
+
+# Returns the long-lived connection for the DB in the given directory, opening it if needed. The connection
+# is in autocommit mode so statements run outside of a transaction scope are committed immediately
+def connect_db(db_dir):
+    state = _thread_state()
+    conn = state.connections.get(db_dir)
+    if conn is None:
+        conn = sqlite3.connect(db_dir + 'data.db', isolation_level=None)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        state.connections[db_dir] = conn
+        state.transaction_depth[db_dir] = 0
+    return conn
+
+
+# Closes the connection held by the current thread. If no directory is given, all connections are closed
+def close_db(db_dir=None):
+    state = _thread_state()
+    dirs = [db_dir] if db_dir is not None else list(state.connections)
+    for curr_dir in dirs:
+        conn = state.connections.pop(curr_dir, None)
+        state.transaction_depth.pop(curr_dir, None)
+        if conn is not None:
+            conn.close()
+
+
+# Copies the DB in one directory to another directory using SQLite's online backup, so the copy is
+# consistent even if the source DB is being written to at the same time. The source DB is opened read only. If
+# it has no WAL file nothing has it open for writing, so it is also opened as immutable, which stops SQLite from
+# creating the WAL and shared memory files next to it
+def backup_db(db_dir, target_dir):
+    source_uri = 'file:' + urllib.parse.quote(db_dir + 'data.db') + '?mode=ro'
+    if not os.path.exists(db_dir + 'data.db-wal'):
+        source_uri = source_uri + '&immutable=1'
+    source_conn = sqlite3.connect(source_uri, uri=True)
+    target_conn = sqlite3.connect(target_dir + 'data.db')
+    try:
+        source_conn.backup(target_conn)
+    finally:
+        target_conn.close()
+        source_conn.close()
+
+
+""" Opens a transaction scope on the shared connection and yields a cursor.
+
+    Scopes can be nested so callers are able to group several of the functions in this module into a single
+    transaction. Only the outermost scope commits, and an exception in any scope rolls back the whole transaction.
+"""
+@contextmanager
+def transaction(db_dir):
+    state = _thread_state()
+    conn = connect_db(db_dir)
+    depth = state.transaction_depth[db_dir]
+    if depth == 0:
+        conn.execute('BEGIN IMMEDIATE')
+    state.transaction_depth[db_dir] = depth + 1
+    try:
+        yield conn.cursor()
+    except BaseException:
+        state.transaction_depth[db_dir] = depth
+        if depth == 0:
+            conn.rollback()
+        raise
+    state.transaction_depth[db_dir] = depth
+    if depth == 0:
+        conn.commit()
+
+
+# Creates the DB if needed and upgrades it in place to the latest schema version. Each migration
+# runs in its own transaction and records its version once it has been applied
 def initialize_db(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version int PRIMARY KEY,
+                applied_date int
+            )
+        ''')
+
+    current_version = get_schema_version(db_dir)
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current_version:
+            continue
+        with transaction(db_dir) as c:
+            migration(db_dir)
+            c.execute('INSERT INTO schema_version (version, applied_date) VALUES (?, ?)', (version, time.time()))
+
+
+def get_schema_version(db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('SELECT max(version) FROM schema_version')
+    result = c.fetchone()
+    if result is None or result[0] is None:
+        return 0
+    return result[0]
+
+
+# Version 1: The original tables. DBs created before schema versioning was added will already have these
+def migrate_base_tables(db_dir):
     if table_exists('episodes', db_dir) == 0:
         create_episode_table(db_dir)
     if table_exists('series', db_dir) == 0:
@@ -17,56 +150,411 @@ def initialize_db(db_dir):
         create_channels_table(db_dir)
 
 
+# Version 2: Unique keys and lookup indexes. Any duplicate rows left behind by previous re-ingests are
+# removed first so the unique indexes can be created
+def migrate_keys_and_indexes(db_dir):
+    with transaction(db_dir) as c:
+        # For duplicated episodes keep the row which has the local file information. SQLite takes the bare
+        # rowid column from the row which produced the max() value
+        c.execute('''
+            DELETE FROM episodes
+            WHERE rowid NOT IN (
+                SELECT rowid
+                FROM (
+                    SELECT rowid, max(file_path IS NOT NULL)
+                    FROM episodes
+                    GROUP BY series_id, season, episode
+                )
+            )
+        ''')
+        c.execute('CREATE UNIQUE INDEX episodes_season_episode ON episodes (series_id, season, episode)')
+
+        # Covers the in order episode retrieval used for channel planning
+        c.execute('CREATE INDEX episodes_absolute_order ON episodes (series_id, absolute_order, length, file_path)')
+
+        c.execute('''
+            DELETE FROM series
+            WHERE rowid NOT IN (
+                SELECT min(rowid)
+                FROM series
+                GROUP BY local_series_name
+            )
+        ''')
+        c.execute('CREATE UNIQUE INDEX series_local_series_name ON series (local_series_name)')
+        c.execute('CREATE INDEX series_series_id ON series (series_id)')
+
+        c.execute('''
+            DELETE FROM channels
+            WHERE rowid NOT IN (
+                SELECT max(rowid)
+                FROM channels
+                GROUP BY channel
+            )
+        ''')
+        c.execute('CREATE UNIQUE INDEX channels_channel ON channels (channel)')
+
+
+# Version 3: Cached chunk plans. Every change to a series' episodes bumps the series' episodes version
+# which invalidates all of the chunk plans computed against the previous version
+def migrate_chunk_plans(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('ALTER TABLE series ADD COLUMN episodes_version int DEFAULT 0')
+        c.execute('''
+            CREATE TABLE chunk_plans (
+                series_id int,
+                chunk_offset int,
+                segments_per_chunk int,
+                segment_runtime real,
+                episodes_version int,
+                plan text,
+                PRIMARY KEY (series_id, chunk_offset, segments_per_chunk, segment_runtime)
+            )
+        ''')
+        for trigger_name, trigger_event, row in [('insert', 'INSERT', 'NEW'),
+                                                 ('update', 'UPDATE', 'NEW'),
+                                                 ('delete', 'DELETE', 'OLD')]:
+            c.execute('''
+                CREATE TRIGGER episodes_version_''' + trigger_name + ''' AFTER ''' + trigger_event + ''' ON episodes
+                BEGIN
+                    UPDATE series
+                    SET episodes_version = episodes_version + 1
+                    WHERE series_id = ''' + row + '''.series_id;
+                END
+            ''')
+
+
+# Version 4: Per show channel state. The chunk offsets and played chunks previously stored as '|' and ','
+# separated strings in the channels table are moved into their own tables
+def migrate_channel_show_state(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE channel_show_state (
+                channel text,
+                show_index int,
+                chunk_offset int,
+                PRIMARY KEY (channel, show_index)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE channel_played_chunks (
+                channel text,
+                show_index int,
+                chunk_id int,
+                PRIMARY KEY (channel, show_index, chunk_id)
+            ) WITHOUT ROWID
+        ''')
+
+        c.execute('SELECT channel, played_chunks, chunk_offset FROM channels')
+        for channel, played_chunks, chunk_offsets in c.fetchall():
+            if chunk_offsets is not None:
+                offset_params = [(channel, idx, int(offset)) for idx, offset in enumerate(str(chunk_offsets).split('|'))]
+                c.executemany('INSERT INTO channel_show_state (channel, show_index, chunk_offset) VALUES (?, ?, ?)',
+                              offset_params)
+            if played_chunks is not None:
+                played_params = []
+                for idx, chunk_string in enumerate(played_chunks.split('|')):
+                    played_params.extend((channel, idx, int(chunk_id)) for chunk_id in chunk_string.split(',') if chunk_id)
+                c.executemany('INSERT OR IGNORE INTO channel_played_chunks (channel, show_index, chunk_id) VALUES (?, ?, ?)',
+                              played_params)
+
+
+# Version 5: Index of the video files found in each show directory, used to only probe the files which
+# have been added or changed since the last scan
+def migrate_media_files(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE media_files (
+                file_path text PRIMARY KEY,
+                series_id int,
+                size int,
+                mtime_ns int,
+                inode int
+            )
+        ''')
+        c.execute('CREATE INDEX media_files_series_id ON media_files (series_id)')
+
+
+# Version 6: Cache of probed video lengths keyed by file content rather than by path or series, so moving
+# or renaming files doesn't require probing them again
+def migrate_probe_cache(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE probe_cache (
+                file_key text PRIMARY KEY,
+                length real,
+                file_path text,
+                last_seen int
+            )
+        ''')
+
+
+# Version 7: Schedule position of channels in rolling mode, which have their schedule extended a window at a
+# time while they keep running
+def migrate_channel_rolling_state(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE channel_rolling_state (
+                channel text PRIMARY KEY,
+                window_index int,
+                schedule_end real,
+                show_index int
+            )
+        ''')
+
+
+# Version 8: Planned schedule of each channel, so a restarted channel can carry on from where its schedule is
+# at and other tools can look up what is on a channel at a given time
+def migrate_channel_schedule(db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE channel_schedule (
+                channel text,
+                position int,
+                start_time real,
+                length real,
+                file_path text,
+                series_id int,
+                absolute_order int,
+                PRIMARY KEY (channel, position)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('CREATE INDEX channel_schedule_start_time ON channel_schedule (channel, start_time)')
+
+
+# The schema migrations in version order. New migrations must only ever be appended to this list
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_keys_and_indexes,
+    migrate_chunk_plans,
+    migrate_channel_show_state,
+    migrate_media_files,
+    migrate_probe_cache,
+    migrate_channel_rolling_state,
+    migrate_channel_schedule
+]
+
+
 def create_episode_table(db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    with transaction(db_dir) as c:
+        c.execute('''
+            CREATE TABLE episodes (
+                series_id int,
+                absolute_order int,
+                season integer,
+                episode integer,
+                title text,
+                subtitle text,
+                description text,
+                length real,
+                file_path text
+            )
+        ''')
 
-    c.execute('''
-        CREATE TABLE episodes (
-            series_id int,
-            absolute_order int,
-            season integer,
-            episode integer,
-            title text,
-            subtitle text,
-            description text,
-            length real,
-            file_path text
-        )
-    ''')
-    conn.commit()
-    conn.close()
+
+# Re-saving an episode which already exists updates its TV Maze information in place
+EPISODE_UPSERT = '''
+    INSERT INTO episodes (series_id, season, episode, title, subtitle, description)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (series_id, season, episode) DO UPDATE
+    SET title = excluded.title,
+        subtitle = excluded.subtitle,
+        description = excluded.description
+'''
 
 
 def save_tv_maze_episode(series_id, season, episode, title, subtitle, desc, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
-    params = (series_id, season, episode, title, subtitle, desc)
-    c.execute('INSERT INTO episodes (series_id, season, episode, title, subtitle, description) VALUES (?, ?, ?, ?, ?, ?)', params)
-    conn.commit()
-    conn.close()
+    with transaction(db_dir) as c:
+        params = (series_id, season, episode, title, subtitle, desc)
+        c.execute(EPISODE_UPSERT, params)
+
+
+# Saves a full list of TV Maze episodes for a series in a single transaction. Each episode is a tuple of
+# (season, episode, title, subtitle, description)
+def save_tv_maze_episodes(series_id, episodes, db_dir):
+    with transaction(db_dir) as c:
+        params = [(series_id,) + tuple(curr) for curr in episodes]
+        c.executemany(EPISODE_UPSERT, params)
+
+
+""" Applies a freshly retrieved TV Maze episode list to a series, only writing the episodes which are new or
+    whose information has changed. Each episode is a tuple of (season, episode, title, subtitle, description).
+
+    The absolute order of the series is only recomputed when new episodes were added. Files which weren't
+    matched to an episode on a previous scan are removed from the file index so the next scan can match them
+    to the new episodes. Returns the number of episodes written.
+"""
+def refresh_tv_maze_episodes(series_id, episodes, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            SELECT season, episode, title, subtitle, description
+            FROM episodes
+            WHERE series_id = ?
+        ''', (series_id,))
+        existing = {(row[0], row[1]): tuple(row[2:]) for row in c.fetchall()}
+
+        changed_episodes = []
+        is_order_changed = False
+        for curr in episodes:
+            curr = tuple(curr)
+            key = (curr[0], curr[1])
+            if key not in existing:
+                is_order_changed = True
+            elif existing[key] == curr[2:]:
+                continue
+            changed_episodes.append(curr)
+
+        if changed_episodes:
+            save_tv_maze_episodes(series_id, changed_episodes, db_dir)
+        if is_order_changed:
+            populate_series_absolute_order(series_id, db_dir)
+            c.execute('''
+                DELETE FROM media_files
+                WHERE
+                    series_id = ? AND
+                    file_path NOT IN (
+                        SELECT file_path
+                        FROM episodes
+                        WHERE
+                            series_id = ? AND
+                            file_path IS NOT NULL
+                    )
+            ''', (series_id, series_id))
+    return len(changed_episodes)
 
 
 def save_local_episode(series_id, season, episode, length, file_path, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
-    params = (length, file_path, series_id, season, episode,)
+    with transaction(db_dir) as c:
+        params = (length, file_path, series_id, season, episode,)
+        c.execute('''
+            UPDATE episodes
+            SET length = ?,
+                file_path = ?
+            WHERE
+                series_id = ? AND
+                season = ? AND
+                episode = ?
+        ''', params)
+
+
+# Saves the local file information for a batch of episodes in a single transaction. Each episode is a tuple
+# of (season, episode, length, file_path)
+def save_local_episodes(series_id, episodes, db_dir):
+    with transaction(db_dir) as c:
+        params = [(length, file_path, series_id, season, episode) for season, episode, length, file_path in episodes]
+        c.executemany('''
+            UPDATE episodes
+            SET length = ?,
+                file_path = ?
+            WHERE
+                series_id = ? AND
+                season = ? AND
+                episode = ?
+        ''', params)
+
+
+# Retrieves the lengths of all episodes of a series which have a local file, keyed by file path
+def get_local_episode_lengths(series_id, db_dir):
+    c = connect_db(db_dir).cursor()
     c.execute('''
-        UPDATE episodes
-        SET length = ?,
-            file_path = ?
+        SELECT file_path, length
+        FROM episodes
         WHERE
             series_id = ? AND
-            season = ? AND
-            episode = ?
-    ''', params)
-    conn.commit()
-    conn.close()
+            file_path IS NOT NULL
+    ''', (series_id,))
+    return dict(c.fetchall())
+
+
+# Retrieves the indexed files of a series as a dict of file path to (size, mtime_ns, inode)
+def get_media_file_index(series_id, db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('''
+        SELECT file_path, size, mtime_ns, inode
+        FROM media_files
+        WHERE series_id = ?
+    ''', (series_id,))
+    return {row[0]: tuple(row[1:]) for row in c.fetchall()}
+
+
+# Adds or updates files in the index. Each file is a tuple of (file_path, size, mtime_ns, inode)
+def save_media_files(series_id, files, db_dir):
+    with transaction(db_dir) as c:
+        params = [(file_path, series_id, size, mtime_ns, inode) for file_path, size, mtime_ns, inode in files]
+        c.executemany('''
+            INSERT OR REPLACE INTO media_files (file_path, series_id, size, mtime_ns, inode)
+            VALUES (?, ?, ?, ?, ?)
+        ''', params)
+
+
+# Removes files which no longer exist from the index and clears the local file information of their episodes
+def delete_media_files(series_id, file_paths, db_dir):
+    with transaction(db_dir) as c:
+        params = [(series_id, file_path) for file_path in file_paths]
+        c.executemany('''
+            UPDATE episodes
+            SET length = NULL,
+                file_path = NULL
+            WHERE
+                series_id = ? AND
+                file_path = ?
+        ''', params)
+        c.executemany('DELETE FROM media_files WHERE series_id = ? AND file_path = ?', params)
+
+
+# Retrieves the cached length of a file by its content key. A cache hit records the path the file was last
+# seen at along with the time it was seen, which are used to evict the entries of files which no longer exist
+def get_cached_probe_length(file_key, file_path, db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('SELECT length FROM probe_cache WHERE file_key = ?', (file_key,))
+    result = c.fetchone()
+    if result is None:
+        return None
+
+    curr_time = int(time.time())
+    with transaction(db_dir) as c:
+        c.execute('''
+            UPDATE probe_cache
+            SET file_path = ?,
+                last_seen = ?
+            WHERE
+                file_key = ? AND
+                (file_path != ? OR last_seen < ?)
+        ''', (file_path, curr_time, file_key, file_path, curr_time - PROBE_CACHE_TOUCH_INTERVAL))
+    return result[0]
+
+
+def save_cached_probe_length(file_key, file_path, length, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            INSERT OR REPLACE INTO probe_cache (file_key, length, file_path, last_seen)
+            VALUES (?, ?, ?, ?)
+        ''', (file_key, length, file_path, int(time.time())))
+
+
+# Removes the cache entries which haven't been seen for the given number of seconds and whose file no longer
+# exists at the path it was last seen at
+def evict_probe_cache(max_age, db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('''
+        SELECT file_key, file_path
+        FROM probe_cache
+        WHERE last_seen < ?
+    ''', (int(time.time()) - max_age,))
+    evicted_keys = [(file_key,) for file_key, file_path in c.fetchall() if not os.path.exists(file_path)]
+    with transaction(db_dir) as c:
+        c.executemany('DELETE FROM probe_cache WHERE file_key = ?', evicted_keys)
+    return len(evicted_keys)
+
+
+# Returns the number of episodes in the DB along with the number of them which have a local file
+def count_episodes(db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('SELECT count(*), count(file_path) FROM episodes')
+    return c.fetchone()
 
 
 def get_episode_by_season_episode(series_id, season, episode, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     params = (series_id, season, episode)
     c.execute('''
         SELECT *
@@ -93,13 +581,11 @@ def get_episode_by_season_episode(series_id, season, episode, db_dir):
     else:
         result = None
 
-    conn.close()
     return result
 
 
 def get_episode_by_absolute_order(series_id, absolute_order, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     params = (series_id, absolute_order)
     c.execute('''
         SELECT *
@@ -125,13 +611,11 @@ def get_episode_by_absolute_order(series_id, absolute_order, db_dir):
     else:
         result = None
 
-    conn.close()
     return result
 
 
 def get_episodes_in_order(series_id, absolute_order, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     c.execute('''
         SELECT *
         FROM episodes
@@ -161,50 +645,39 @@ def get_episodes_in_order(series_id, absolute_order, db_dir):
 
 
 # This function will populate the absolute order column for all episodes in a given series.
-# This order will be used to determine playback order for an in order series
+# This order will be used to determine playback order for an in order series.
+# The episodes of the series are numbered in one pass with the ROW_NUMBER window function, which needs
+# SQLite 3.25 or newer, so the whole series is renumbered by a single UPDATE statement
 def populate_series_absolute_order(series_id, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
-
-    c.execute('''
-        SELECT season, episode
-        FROM episodes
-        WHERE series_id = ?
-        ORDER BY season ASC, episode ASC
-    ''', (series_id,))
-
-    rows = c.fetchall()
-    counter = 0
-    for row in rows:
-        params = (counter, series_id, row[0], row[1],)
+    with transaction(db_dir) as c:
         c.execute('''
+            WITH numbered AS (
+                SELECT
+                    rowid AS episode_rowid,
+                    ROW_NUMBER() OVER (ORDER BY season, episode) - 1 AS absolute_order
+                FROM episodes
+                WHERE series_id = ?
+            )
             UPDATE episodes
-            SET absolute_order = ?
-            WHERE
-                series_id = ? AND
-                season = ? AND
-                episode = ?
-        ''', params)
-        counter = counter + 1
-
-    conn.commit()
-    conn.close()
+            SET absolute_order = (
+                SELECT numbered.absolute_order
+                FROM numbered
+                WHERE numbered.episode_rowid = episodes.rowid
+            )
+            WHERE series_id = ?
+        ''', (series_id, series_id))
 
 
 def create_series_table(db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
-
-    # The local series name field is the series name as found in the video files
-    c.execute('''
-                CREATE TABLE series (
-                    series_id int,
-                    local_series_name text,
-                    last_updated_date int
-                )
-            ''')
-    conn.commit()
-    conn.close()
+    with transaction(db_dir) as c:
+        # The local series name field is the series name as found in the video files
+        c.execute('''
+                    CREATE TABLE series (
+                        series_id int,
+                        local_series_name text,
+                        last_updated_date int
+                    )
+                ''')
 
 
 def save_series(local_series_name, db_dir):
@@ -212,21 +685,16 @@ def save_series(local_series_name, db_dir):
 
 
 def save_series_id(series_id, series, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
-    params = (series_id, series,)
-    c.execute('INSERT INTO series (series_id, local_series_name) VALUES (?, ?)', params)
-    conn.commit()
-    conn.close()
+    with transaction(db_dir) as c:
+        params = (series_id, series,)
+        c.execute('INSERT INTO series (series_id, local_series_name) VALUES (?, ?)', params)
 
 
 # Retrieves the TV Maze series ID for a show.
 def get_series_id(local_series_name, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     result = c.execute('SELECT series_id FROM series WHERE local_series_name = ?', (local_series_name,))
     rows = result.fetchall()
-    conn.close()
     if len(rows) == 1:
         return rows[0][0]
 
@@ -238,132 +706,281 @@ def get_series_id(local_series_name, db_dir):
 
 
 def is_series_metadata_loaded(local_series_name, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     c.execute('''
         SELECT last_updated_date
         FROM series
         WHERE local_series_name = ?
     ''', (local_series_name,))
     result = c.fetchone()
-    conn.close()
     if result is None or result[0] is None:
         return False
     return True
 
 
-def update_series_last_updated_time(local_series_name, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+# Retrieves the (local series name, series ID) of the given series whose metadata was last updated more than
+# max_age seconds ago, least recently updated first
+def get_stale_series(max_age, local_series_names, db_dir):
+    c = connect_db(db_dir).cursor()
     c.execute('''
-        UPDATE series
-        SET last_updated_date = ?
-        WHERE local_series_name = ?
-    ''', (time.time(), local_series_name,))
-    conn.commit()
-    conn.close()
+        SELECT local_series_name, series_id
+        FROM series
+        WHERE
+            last_updated_date IS NOT NULL AND
+            last_updated_date < ?
+        ORDER BY
+            last_updated_date asc
+    ''', (time.time() - max_age,))
+    names = set(local_series_names)
+    return [row for row in c.fetchall() if row[0] in names]
 
 
-def create_channels_table(db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+def update_series_last_updated_time(local_series_name, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            UPDATE series
+            SET last_updated_date = ?
+            WHERE local_series_name = ?
+        ''', (time.time(), local_series_name,))
 
-# Channel type is sequential or random
-# Next episode season and num will be the next episode to start streaming from. (Remember, attempt to only create streams for 24 hr intervals)
-    c.execute('''
-            CREATE TABLE channels (
-                channel text,
-                playback_order text,
-                shows text,
-                next_episode text,
-                played_chunks text,
-                chunk_offset int,
-                config_hash text
-            )
-        ''')
-    conn.commit()
-    conn.close()
+
+def create_channels_table(db_dir):
+    with transaction(db_dir) as c:
+        # Channel type is sequential or random
+        # Next episode season and num will be the next episode to start streaming from. (Remember, attempt to only create streams for 24 hr intervals)
+        c.execute('''
+                CREATE TABLE channels (
+                    channel text,
+                    playback_order text,
+                    shows text,
+                    next_episode text,
+                    played_chunks text,
+                    chunk_offset int,
+                    config_hash text
+                )
+            ''')
 
 
 def save_channel(channel, order, shows, config_hash, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    with transaction(db_dir) as c:
+        params = (channel, order, shows, config_hash)
+        c.execute('''
+            INSERT INTO channels (channel, playback_order, shows, config_hash)
+            VALUES (?, ?, ?, ?)
+        ''', params)
 
-    params = (channel, order, shows, config_hash)
-    c.execute('''
-        INSERT INTO channels (channel, playback_order, shows, config_hash)
-        VALUES (?, ?, ?, ?)
-    ''', params)
-    conn.commit()
-    conn.close()
+def update_channel(channel, order, shows, config_hash, db_dir):
+    with transaction(db_dir) as c:
+        params = (order, shows, config_hash, channel)
+        c.execute('''
+            UPDATE channels
+            SET playback_order = ?,
+                shows = ?,
+                played_chunks = NULL,
+                chunk_offset = NULL,
+                config_hash = ?
+            WHERE channel = ?
+        ''', params)
 
-def update_and_reset_channel(channel, order, shows, config_hash, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
 
-    params = (order, shows, config_hash, channel)
+# Clears the show state, rolling state and saved schedule of a channel so it is scheduled from the start
+def reset_channel_state(channel, db_dir):
+    with transaction(db_dir):
+        delete_channel_show_state(channel, db_dir)
+        delete_channel_rolling_state(channel, db_dir)
+        delete_channel_schedule(channel, db_dir)
+
+def delete_channel(channel, db_dir):
+    with transaction(db_dir) as c:
+        params = (channel,)
+        c.execute('''
+            DELETE FROM channels
+            WHERE channel = ?
+        ''', params)
+        delete_channel_show_state(channel, db_dir)
+        delete_channel_rolling_state(channel, db_dir)
+        delete_channel_schedule(channel, db_dir)
+
+
+def update_channel_next_episode(channel, next_episode, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            UPDATE channels
+            SET next_episode = ?
+            WHERE channel = ?
+        ''', (next_episode, channel))
+
+
+# Retrieves the chunk offset and the set of played chunk IDs for each show on a channel. Shows without any
+# saved state start at a chunk offset of 0 with no played chunks
+def get_channel_show_state(channel, show_count, db_dir):
+    chunk_offsets = [0] * show_count
+    played_chunks = [set() for _ in range(show_count)]
+
+    c = connect_db(db_dir).cursor()
     c.execute('''
-        UPDATE channels
-        SET playback_order = ?,
-            shows = ?,
-            played_chunks = NULL,
-            chunk_offset = NULL,
-            config_hash = ?
+        SELECT show_index, chunk_offset
+        FROM channel_show_state
         WHERE channel = ?
-    ''', params)
+    ''', (channel,))
+    for show_index, chunk_offset in c.fetchall():
+        if show_index < show_count:
+            chunk_offsets[show_index] = chunk_offset
 
-    conn.commit()
-    conn.close()
+    c.execute('''
+        SELECT show_index, chunk_id
+        FROM channel_played_chunks
+        WHERE channel = ?
+    ''', (channel,))
+    for show_index, chunk_id in c.fetchall():
+        if show_index < show_count:
+            played_chunks[show_index].add(chunk_id)
 
-def delete_channel(channel, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    return chunk_offsets, played_chunks
 
-    params = (channel,)
+
+""" Saves the changes to the show state of a channel.
+
+    The played chunks of every show index in cleared_shows are removed first, then the newly played chunks
+    (a list of chunk ID collections per show) are added and the chunk offsets of all shows are saved.
+"""
+def update_channel_show_state(channel, chunk_offsets, new_played_chunks, cleared_shows, db_dir):
+    with transaction(db_dir) as c:
+        c.executemany('''
+            DELETE FROM channel_played_chunks
+            WHERE channel = ? AND show_index = ?
+        ''', [(channel, show_index) for show_index in cleared_shows])
+
+        played_params = []
+        for show_index, chunk_ids in enumerate(new_played_chunks):
+            played_params.extend((channel, show_index, chunk_id) for chunk_id in chunk_ids)
+        c.executemany('''
+            INSERT OR IGNORE INTO channel_played_chunks (channel, show_index, chunk_id)
+            VALUES (?, ?, ?)
+        ''', played_params)
+
+        c.executemany('''
+            INSERT OR REPLACE INTO channel_show_state (channel, show_index, chunk_offset)
+            VALUES (?, ?, ?)
+        ''', [(channel, show_index, chunk_offset) for show_index, chunk_offset in enumerate(chunk_offsets)])
+
+
+def delete_channel_show_state(channel, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('DELETE FROM channel_show_state WHERE channel = ?', (channel,))
+        c.execute('DELETE FROM channel_played_chunks WHERE channel = ?', (channel,))
+
+
+# Retrieves the schedule position of a channel in rolling mode: the index of the last window written, the
+# time the schedule ends at and the index of the show the next window starts with
+def get_channel_rolling_state(channel, db_dir):
+    c = connect_db(db_dir).cursor()
     c.execute('''
-        DELETE FROM channels
+        SELECT window_index, schedule_end, show_index
+        FROM channel_rolling_state
         WHERE channel = ?
-    ''', params)
+    ''', (channel,))
+    result = c.fetchone()
+    if result is None:
+        return None
+    return {
+        'window_index': result[0],
+        'schedule_end': result[1],
+        'show_index': result[2]
+    }
 
-    conn.commit()
-    conn.close()
 
+def save_channel_rolling_state(channel, window_index, schedule_end, show_index, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            INSERT OR REPLACE INTO channel_rolling_state (channel, window_index, schedule_end, show_index)
+            VALUES (?, ?, ?, ?)
+        ''', (channel, window_index, schedule_end, show_index))
 
-def update_channel_next_episode(channel, next_episode, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+
+def delete_channel_rolling_state(channel, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('DELETE FROM channel_rolling_state WHERE channel = ?', (channel,))
+
+
+""" Appends entries to the saved schedule of a channel. Each entry is a tuple of
+    (start_time, length, file_path, series_id, absolute_order). Entries which finished more than the given
+    number of seconds ago are removed at the same time.
+"""
+def append_channel_schedule(channel, entries, keep_past, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('''
+            DELETE FROM channel_schedule
+            WHERE channel = ? AND start_time + length < ?
+        ''', (channel, time.time() - keep_past))
+
+        c.execute('SELECT max(position) FROM channel_schedule WHERE channel = ?', (channel,))
+        last_position = c.fetchone()[0]
+        first_position = last_position + 1 if last_position is not None else 0
+        c.executemany('''
+            INSERT INTO channel_schedule (channel, position, start_time, length, file_path, series_id, absolute_order)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(channel, first_position + idx) + tuple(entry) for idx, entry in enumerate(entries)])
+
+
+# Retrieves the saved schedule of a channel as tuples of
+# (position, start_time, length, file_path, series_id, absolute_order) in order
+def get_channel_schedule(channel, db_dir):
+    c = connect_db(db_dir).cursor()
     c.execute('''
-        UPDATE channels
-        SET next_episode = ?
+        SELECT position, start_time, length, file_path, series_id, absolute_order
+        FROM channel_schedule
         WHERE channel = ?
-    ''', (next_episode, channel))
-    conn.commit()
-    conn.close()
+        ORDER BY position asc
+    ''', (channel,))
+    return c.fetchall()
 
 
-def update_channel_chunks(channel, played_chunks, chunk_offsets, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+# Returns the number of saved schedule entries across all channels
+def count_schedule_entries(db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('SELECT count(*) FROM channel_schedule')
+    return c.fetchone()[0]
+
+
+# Retrieves the schedule entries of a channel playing at the given time and right after it. Either entry is
+# None if there is nothing scheduled
+def get_channel_now_next(channel, timestamp, db_dir):
+    c = connect_db(db_dir).cursor()
     c.execute('''
-        UPDATE channels
-        SET played_chunks = ?,
-            chunk_offset = ?
-        WHERE channel = ?
-    ''', (played_chunks, chunk_offsets, channel))
-    conn.commit()
-    conn.close()
+        SELECT position, start_time, length, file_path, series_id, absolute_order
+        FROM channel_schedule
+        WHERE channel = ? AND start_time <= ?
+        ORDER BY start_time desc
+        LIMIT 1
+    ''', (channel, timestamp))
+    now_entry = c.fetchone()
+    if now_entry is not None and now_entry[1] + now_entry[2] <= timestamp:
+        now_entry = None
+
+    c.execute('''
+        SELECT position, start_time, length, file_path, series_id, absolute_order
+        FROM channel_schedule
+        WHERE channel = ? AND start_time > ?
+        ORDER BY start_time asc
+        LIMIT 1
+    ''', (channel, timestamp))
+    return now_entry, c.fetchone()
+
+
+def delete_channel_schedule(channel, db_dir):
+    with transaction(db_dir) as c:
+        c.execute('DELETE FROM channel_schedule WHERE channel = ?', (channel,))
 
 
 def get_channel(channel, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     c.execute('''
         SELECT *
         FROM channels
         WHERE channel = ?
     ''', (channel, ))
     result = c.fetchone()
-    conn.close()
     if not (result is None):
         return {
             'channel': result[0],
@@ -376,78 +993,159 @@ def get_channel(channel, db_dir):
     return None
 
 def get_channel_config_hash(channel, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     c.execute('''
         SELECT config_hash
         FROM channels
         WHERE channel = ?
     ''', (channel, ))
     result = c.fetchone()
-    conn.close()
     if not (result is None):\
         return result[0]
     return None
 
-""" Retrieves all episodes for a show split into chunks.
-    
-    A chunk is made up of a number of segments.
-    A segment is a grouping of the minimum number of episodes with a runtime greater than
-        the user defined runtime
-"""
-def get_show_in_chunks(series_id, chunk_offset, segments_per_chunk, segment_runtime, db_dir):
+def get_series_episodes_version(series_id, db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('SELECT max(episodes_version) FROM series WHERE series_id = ?', (series_id,))
+    result = c.fetchone()
+    if result is None or result[0] is None:
+        return 0
+    return result[0]
 
-    # First get all the episodes in order
-    db_episodes = get_episodes_in_order(series_id, 0, db_dir)
 
-    # Separate the list of episodes into chunks
-    chunks_list = []
-    curr_chunk = []
-    curr_segment = []
-    curr_segment_runtime = 0
-    curr_chunk_segment_count = 0
+# Retrieves a cached chunk plan for a series. A chunk plan is the list of the number of episodes in each
+# chunk. None is returned if no plan has been cached for the current version of the series' episodes
+def get_chunk_plan(series_id, chunk_offset, segments_per_chunk, segment_runtime, episodes_version, db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('''
+        SELECT plan
+        FROM chunk_plans
+        WHERE
+            series_id = ? AND
+            chunk_offset = ? AND
+            segments_per_chunk = ? AND
+            segment_runtime = ? AND
+            episodes_version = ?
+    ''', (series_id, chunk_offset, segments_per_chunk, segment_runtime, episodes_version))
+    result = c.fetchone()
+    if result is None:
+        return None
+    return json.loads(result[0])
 
-    # First if a non-zero chunk offset is set, create a chunk up to the offset
-    if chunk_offset != 0:
-        chunks_list.append(db_episodes[:chunk_offset])
-        db_episodes = db_episodes[chunk_offset:]
 
-    for idx, episode in enumerate(db_episodes):
+def save_chunk_plan(series_id, chunk_offset, segments_per_chunk, segment_runtime, episodes_version, plan, db_dir):
+    with transaction(db_dir) as c:
+        params = (series_id, chunk_offset, segments_per_chunk, segment_runtime, episodes_version, json.dumps(plan))
+        c.execute('''
+            INSERT OR REPLACE INTO chunk_plans (series_id, chunk_offset, segments_per_chunk, segment_runtime,
+                                                episodes_version, plan)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', params)
 
-        curr_segment.append(episode)
-        curr_segment_runtime += episode['length']
-        # Keep adding to the current segment until the minimum segment runtime is reached
-        if curr_segment_runtime < segment_runtime:
-            continue
 
-        # The current segment has now passed the minimum segment runtime and can be added to the current chunk
-        curr_chunk.extend(curr_segment)
-        curr_chunk_segment_count += 1
-        curr_segment = []
-        curr_segment_runtime = 0
+""" Retrieves the catalog of all episodes for a show in order along with a dict of chunk offset to the chunk
+    ranges for each of the given chunk offsets.
 
-        # If the current chunk has the minimum number of segments required, add the chunk to
-        # the list of chunks
-        if curr_chunk_segment_count >= segments_per_chunk:
-            chunks_list.append(curr_chunk)
-            curr_chunk = []
-            curr_chunk_segment_count = 0
+    A chunk is made up of a number of segments.
+    A segment is a grouping of the minimum number of episodes with a runtime greater than
+        the user defined runtime
+
+    The chunk boundaries are cached in the DB per series, chunk offset and chunk parameters so
+    they only need to be computed again once the series' episodes change.
+"""
+def get_show_chunk_plans(series_id, chunk_offsets, segments_per_chunk, segment_runtime, db_dir):
+    series_catalog, episodes_version = get_series_catalog(series_id, db_dir)
+    chunk_plans = {}
+    for chunk_offset in chunk_offsets:
+        chunk_plans[chunk_offset] = get_catalog_chunk_ranges(series_catalog, episodes_version, chunk_offset,
+                                                             segments_per_chunk, segment_runtime, db_dir)
+    return series_catalog, chunk_plans
+
+
+# Returns the (start, end) index range of each chunk of a series catalog, using the saved chunk plan if there
+# is one for the given episodes version
+def get_catalog_chunk_ranges(series_catalog, episodes_version, chunk_offset, segments_per_chunk, segment_runtime,
+                             db_dir):
+    series_id = series_catalog.series_id
+    plan = get_chunk_plan(series_id, chunk_offset, segments_per_chunk, segment_runtime, episodes_version, db_dir)
+    if plan is not None:
+        ranges = []
+        start = 0
+        for chunk_length in plan:
+            # Plans saved before empty chunks were left out may still hold them
+            if chunk_length == 0:
+                continue
+            ranges.append((start, start + chunk_length))
+            start += chunk_length
+        return ranges
+
+    ranges = chunking.chunk_ranges(series_catalog.lengths, chunk_offset, segments_per_chunk, segment_runtime,
+                                   series_catalog.offsets)
+    plan = [end - start for start, end in ranges]
+    save_chunk_plan(series_id, chunk_offset, segments_per_chunk, segment_runtime, episodes_version, plan, db_dir)
+    return ranges
+
+
+def get_catalog_path(series_id, db_dir):
+    return db_dir + CATALOG_SUBDIR + str(series_id) + '.bin'
+
+
+# Retrieves the planning catalog of all episodes with local files for a series along with the episodes
+# version it was built from. The catalog is loaded from its snapshot file, which is rebuilt from the DB
+# whenever the series' episodes have changed
+def get_series_catalog(series_id, db_dir):
+
+    # The version must be read before the episodes so a catalog is never saved against newer episodes
+    episodes_version = get_series_episodes_version(series_id, db_dir)
+    cached = _catalog_cache.get((db_dir, series_id))
+    if cached is not None and cached[0] == episodes_version:
+        return cached[1], episodes_version
+    description_loader = functools.partial(get_episode_description, db_dir=db_dir)
+
+    snapshot_path = get_catalog_path(series_id, db_dir)
+    series_catalog = catalog.load_snapshot(snapshot_path, series_id, episodes_version, description_loader)
+    if series_catalog is not None:
+        _catalog_cache[(db_dir, series_id)] = (episodes_version, series_catalog)
+        return series_catalog, episodes_version
+
+    c = connect_db(db_dir).cursor()
+    c.execute('''
+        SELECT absolute_order, season, episode, title, subtitle, length, file_path
+        FROM episodes
+        WHERE
+            series_id = ? AND
+            absolute_order >= 0 AND
+            file_path IS NOT NULL
+        ORDER BY
+            absolute_order asc
+    ''', (series_id,))
+    series_catalog = catalog.Catalog.from_rows(series_id, c.fetchall(), description_loader)
+
+    os.makedirs(db_dir + CATALOG_SUBDIR, exist_ok=True)
+    catalog.save_snapshot(series_catalog, snapshot_path, episodes_version)
+    _catalog_cache[(db_dir, series_id)] = (episodes_version, series_catalog)
+    return series_catalog, episodes_version
 
-    # Add any partial chunk or segment which may have been generated at the end
-    if curr_segment:
-        curr_chunk.extend(curr_segment)
-    if curr_chunk:
-        chunks_list.append(curr_chunk)
 
-    return chunks_list
+def get_episode_description(series_id, absolute_order, db_dir):
+    c = connect_db(db_dir).cursor()
+    c.execute('''
+        SELECT description
+        FROM episodes
+        WHERE
+            series_id = ? AND
+            absolute_order = ?
+    ''', (series_id, absolute_order))
+    result = c.fetchone()
+    if result is None:
+        return None
+    return result[0]
 
 
 def table_exists(table_name, db_dir):
-    conn = connect_db(db_dir)
-    c = conn.cursor()
+    c = connect_db(db_dir).cursor()
     c.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
     is_exists = False
     if c.fetchall()[0][0] == 1:
         is_exists = True
-    conn.close()
     return is_exists
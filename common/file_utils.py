@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+
+# Writes a file to a temporary path in the same directory which then replaces the target path. The write
+# function is called with the opened file
+def write_atomically(file_path, write_function):
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as f:
+            write_function(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
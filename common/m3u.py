@@ -1,65 +1,133 @@
 import os
+import re
+import threading
+import time
 import requests
 import urllib.parse
 
-def generate_new_m3u(m3u_path):
-    target_m3u = open(m3u_path, "w")
-    target_m3u.write('#EXTM3U - Generated by Home Broadcaster\n')
-    target_m3u.close()
+import common.file_utils as file_utils
 
+M3U_HEADER = '#EXTM3U - Generated by Home Broadcaster'
 
-def generate_m3u_if_not_exists(m3u_path):
-    if not os.path.exists(m3u_path):
-        generate_new_m3u(m3u_path)
+# Number of seconds the public IP address of the server is reused before it is looked up again
+PUBLIC_ADDRESS_TTL = 60 * 60
 
+_public_address = {
+    'address': None,
+    'resolved_time': 0
+}
+_public_address_lock = threading.Lock()
 
-def remove_channel(channel, m3u_dir):
-    target_m3u_path = m3u_dir + 'tv.m3u'
-    with open(target_m3u_path, "r") as f:
-        lines = f.readlines()
-    with open(target_m3u_path, "w") as f:
-        for line in lines:
-            if not (str("tvg-ID=" + channel + ".tv") in line) and not (str("/" + channel + ".m3u8") in line):
-                f.write(line)
 
-def add_channel(channel, domain_name, port, auth, m3u_dir):
-    add_channel_with_logo(channel, None, domain_name, port, auth, m3u_dir)
+# Returns the address used in the stream URLs. If no domain name is set, the public IP address of the server
+# is looked up, at most once per TTL
+def resolve_url_address(domain_name):
+    if not (domain_name is None):
+        return domain_name
 
-def add_channel_with_logo(channel, logo_file_name, domain_name, port, auth, m3u_dir):
-    target_m3u_path = m3u_dir
-    if not target_m3u_path.endswith('/'):
-        target_m3u_path = target_m3u_path + '/'
-    target_m3u_path = target_m3u_path + 'tv.m3u'
-    generate_m3u_if_not_exists(target_m3u_path)
+    with _public_address_lock:
+        if _public_address['address'] is None or time.time() - _public_address['resolved_time'] > PUBLIC_ADDRESS_TTL:
+            _public_address['address'] = requests.get('https://api.ipify.org').text
+            _public_address['resolved_time'] = time.time()
+        return _public_address['address']
+
+
+""" In memory model of the m3u playlist containing all of the channels.
+
+    The channel entries are indexed by channel name, so adding and removing channels doesn't touch the file.
+    All of the changes are written to the file at once, atomically, by save().
+"""
+class Playlist:
 
-    with open(target_m3u_path) as f:
-        if 'tvg-name=' + channel in f.read():
+    def __init__(self, m3u_path, header=M3U_HEADER, entries=None):
+        self.m3u_path = m3u_path
+        self.header = header
+        # Channel name to the list of lines of the channel's entry
+        self.entries = entries if entries is not None else {}
+        self.is_modified = entries is None
+
+    @classmethod
+    def load(cls, m3u_path):
+        if not os.path.exists(m3u_path):
+            return cls(m3u_path)
+
+        with open(m3u_path) as f:
+            lines = f.read().split('\n')
+
+        entries = {}
+        curr_entry = None
+        for line in lines[1:]:
+            if not line:
+                continue
+            # Channel names may have spaces, so the name runs up to the attribute written after it
+            match = re.search('tvg-name=(.*?)(?: tvg-logo=| group-title=|$)', line)
+            if line.startswith('#EXTINF') and match:
+                curr_entry = []
+                entries[match.group(1)] = curr_entry
+            if curr_entry is None:
+                # Lines before the first channel can't be assigned to a channel so they are kept as their own entry
+                curr_entry = []
+                entries[None] = curr_entry
+            curr_entry.append(line)
+        return cls(m3u_path, lines[0], entries)
+
+    def has_channel(self, channel):
+        return channel in self.entries
+
+    def add_channel(self, channel, logo_file_name, domain_name, port, auth):
+        if self.has_channel(channel):
             # Channel already exists so leave m3u as is
             return
-    target_m3u = open(target_m3u_path, "a")
 
-    if not (domain_name is None):
-        url_address = domain_name
-    else:
-        url_address = requests.get('https://api.ipify.org').text
-
-    if not (logo_file_name is None):
-        logo_file_addr = "http://" + url_address + "/tv/logos/" + logo_file_name
-        target_m3u.write(
-            '\n#EXTINF:-1 tvg-ID=' + channel + '.tv' + ' tvg-name=' + channel + ' tvg-logo=' + logo_file_addr + ' group-title=,' + channel)
-    else:
-        target_m3u.write('\n#EXTINF:-1 tvg-ID=' + channel + '.tv' + ' tvg-name=' + channel + ' group-title=,' + channel)
-
-    if not (auth is None):
-        user = urllib.parse.quote(auth['username'])
-        password = urllib.parse.quote(auth['password'])
-        if not (port is None):
-            target_m3u.write('\nhttp://' + user + ':' + password + '@' + url_address + ':' + port + '/tv/' + channel + '.m3u8')
+        url_address = resolve_url_address(domain_name)
+
+        if not (logo_file_name is None):
+            logo_file_addr = "http://" + url_address + "/tv/logos/" + logo_file_name
+            extinf = '#EXTINF:-1 tvg-ID=' + channel + '.tv' + ' tvg-name=' + channel + ' tvg-logo=' + logo_file_addr + ' group-title=,' + channel
         else:
-            target_m3u.write('\nhttp://' + user + ':' + password + '@' + url_address + '/tv/' + channel + '.m3u8')
-    else:
-        if not (port is None):
-            target_m3u.write('\nhttp://' + url_address + ':' + port + '/tv/' + channel + '.m3u8')
+            extinf = '#EXTINF:-1 tvg-ID=' + channel + '.tv' + ' tvg-name=' + channel + ' group-title=,' + channel
+
+        if not (auth is None):
+            user = urllib.parse.quote(auth['username'])
+            password = urllib.parse.quote(auth['password'])
+            if not (port is None):
+                url = 'http://' + user + ':' + password + '@' + url_address + ':' + port + '/tv/' + channel + '.m3u8'
+            else:
+                url = 'http://' + user + ':' + password + '@' + url_address + '/tv/' + channel + '.m3u8'
         else:
-            target_m3u.write('\nhttp://' + url_address + '/tv/' + channel + '.m3u8')
-    target_m3u.close()
+            if not (port is None):
+                url = 'http://' + url_address + ':' + port + '/tv/' + channel + '.m3u8'
+            else:
+                url = 'http://' + url_address + '/tv/' + channel + '.m3u8'
+
+        self.entries[channel] = [extinf, url]
+        self.is_modified = True
+
+    def remove_channel(self, channel):
+        if self.entries.pop(channel, None) is not None:
+            self.is_modified = True
+
+    def render(self):
+        result = [self.header + '\n']
+        for entry_lines in self.entries.values():
+            for line in entry_lines:
+                result.append('\n' + line)
+        return ''.join(result)
+
+    # Writes the playlist to a temporary file which then replaces the playlist file, so clients never read a
+    # partially written playlist. Nothing is written if the playlist hasn't changed
+    def save(self):
+        if not self.is_modified:
+            return
+
+        playlist_text = self.render()
+        file_utils.write_atomically(self.m3u_path, lambda f: f.write(playlist_text.encode()))
+        self.is_modified = False
+
+
+def get_m3u_path(m3u_dir):
+    target_m3u_path = m3u_dir
+    if not target_m3u_path.endswith('/'):
+        target_m3u_path = target_m3u_path + '/'
+    return target_m3u_path + 'tv.m3u'
+
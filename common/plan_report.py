@@ -0,0 +1,41 @@
+from contextlib import contextmanager
+import json
+import time
+
+# Report of how long each stage of a run took along with counts of what the stage produced. Used to size
+# hardware and check config changes with a plan-only run before any streams are touched.
+
+
+class PlanReport:
+
+    def __init__(self):
+        self.stages = []
+
+    # Times the stage run inside of the scope. The scope yields a dict which the stage fills with its counts
+    @contextmanager
+    def stage(self, name):
+        counts = {}
+        start_time = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.stages.append({
+                'stage': name,
+                'seconds': round(time.perf_counter() - start_time, 3),
+                'counts': counts
+            })
+
+    def total_seconds(self):
+        return round(sum(stage['seconds'] for stage in self.stages), 3)
+
+    def render(self):
+        lines = []
+        for stage in self.stages:
+            counts = ', '.join(name + '=' + str(value) for name, value in stage['counts'].items())
+            lines.append('{:<20} {:>10.3f}s  {}'.format(stage['stage'], stage['seconds'], counts).rstrip())
+        lines.append('{:<20} {:>10.3f}s'.format('total', self.total_seconds()))
+        return '\n'.join(lines)
+
+    def save(self, report_path):
+        with open(report_path, 'w') as f:
+            json.dump({'stages': self.stages, 'total_seconds': self.total_seconds()}, f, indent=2)
@@ -1,6 +1,25 @@
+import common.db_utils as db_utils
+import common.file_utils as file_utils
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import hashlib
 import os
 import re
 import subprocess
+import threading
+
+# One semaphore per storage device, limiting how many ffprobe processes read from the same device at
+# once. Network mounts each have their own device ID so a slow NAS doesn't starve probes of local disks
+_device_semaphores = {}
+_device_semaphores_lock = threading.Lock()
+
+# Limits the total number of ffprobe processes across all of the probe pools running at once. Created with
+# the worker count of the first pool
+_probe_semaphore = None
+
+# Number of bytes hashed from each of the start and end of a file to build its content key
+FILE_KEY_SAMPLE_SIZE = 64 * 1024
 
 
 def generate_concat_playlist(files, playlist_directory, channel_name):
@@ -21,6 +40,83 @@ def generate_concat_playlist(files, playlist_directory, channel_name):
     return target_file_path
 
 
+def get_concat_window_path(playlist_directory, channel_name, window_index):
+    target_file_path = playlist_directory
+    if not target_file_path.endswith('/'):
+        target_file_path = target_file_path + '/'
+    return target_file_path + channel_name + '.' + str(window_index) + '.ffconcat'
+
+
+""" Generates the concat playlist of one window of a channel in rolling mode.
+
+    The last entry of the playlist is the playlist of the next window, which the concat demuxer opens as a
+    nested concat playlist once it reaches the end of this window. The next window's playlist only has to
+    exist by then, so a running FFMPEG process keeps playing as long as windows are written ahead of time.
+    The last window of a chain is generated without the next window.
+"""
+def generate_concat_window(files, playlist_directory, channel_name, window_index, has_next_window=True):
+    target_file_path = get_concat_window_path(playlist_directory, channel_name, window_index)
+    escaped_files = escape_special_chars(files)
+
+    lines = ['ffconcat version 1.0\n']
+    for file in escaped_files:
+        lines.append("file '" + file + "'\n")
+    if has_next_window:
+        lines.extend(get_nested_playlist_lines(
+            get_concat_window_path(playlist_directory, channel_name, window_index + 1)))
+    write_playlist(target_file_path, lines)
+    return target_file_path
+
+
+# Returns the lines of the entry of a nested concat playlist. FFMPEG opens the nested playlist with the
+# default options of the concat demuxer rather than those of the stream, so it would reject the full paths
+# in it as unsafe. The option directive, supported from FFMPEG 5.0, turns the check off for it as well
+def get_nested_playlist_lines(nested_playlist_path):
+    return ["file '" + escape_special_chars([nested_playlist_path])[0] + "'\n", 'option safe 0\n']
+
+
+# Writes the lines of a concat playlist. A channel may be reading the playlist, so it is replaced atomically
+def write_playlist(target_file_path, lines):
+    playlist_text = ''.join(lines)
+    file_utils.write_atomically(target_file_path, lambda f: f.write(playlist_text.encode()))
+
+
+def get_resume_playlist_path(playlist_directory, channel_name):
+    target_file_path = playlist_directory
+    if not target_file_path.endswith('/'):
+        target_file_path = target_file_path + '/'
+    return target_file_path + channel_name + '.resume.ffconcat'
+
+
+# Generates a concat playlist which starts the given number of seconds into the first file. If the path of
+# another playlist is given, it is played once the files have finished
+def generate_resume_playlist(files, inpoint, playlist_directory, channel_name, next_playlist_path=None):
+    target_file_path = get_resume_playlist_path(playlist_directory, channel_name)
+    escaped_files = escape_special_chars(files)
+
+    lines = ['ffconcat version 1.0\n']
+    for idx, file in enumerate(escaped_files):
+        lines.append("file '" + file + "'\n")
+        if idx == 0 and inpoint > 0:
+            lines.append('inpoint ' + '%.3f' % inpoint + '\n')
+    if next_playlist_path is not None:
+        lines.extend(get_nested_playlist_lines(next_playlist_path))
+    write_playlist(target_file_path, lines)
+    return target_file_path
+
+
+# Deletes the window playlists of a channel with an index lower than the given index. If no index is given,
+# all of the channel's window playlists are deleted
+def remove_concat_windows(playlist_directory, channel_name, before_index=None):
+    window_prefix = get_concat_window_path(playlist_directory, channel_name, '')[:-len('.ffconcat')]
+    for window_path in glob.glob(glob.escape(window_prefix) + '*.ffconcat'):
+        window_index = window_path[len(window_prefix):-len('.ffconcat')]
+        if not window_index.isdigit():
+            continue
+        if before_index is None or int(window_index) < before_index:
+            os.remove(window_path)
+
+
 # Returns a list of all files with full paths in a given directory
 def list_files_with_path(directory):
     result = []
@@ -34,6 +130,20 @@ def list_files_with_path(directory):
     return result
 
 
+# Returns a dict of the full path of every file in a given directory to its (size, mtime_ns, inode)
+def list_files_with_stat(directory):
+    result = {}
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name == '.DS_Store':
+                continue
+            stat = entry.stat()
+            result[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    return result
+
+
 # Accepts a file name and returns a tuple of (season, episode)
 def parse_season_episode(file_name):
     match = re.search('S(\\d*)E(\\d*)', file_name)
@@ -54,7 +164,35 @@ def escape_special_chars(input_list):
     return result
 
 
-def get_video_length(filename):
+# Returns a key identifying the content of a file which stays the same when the file is renamed or moved.
+# The key is made up of the size and modification time of the file along with a hash of its first and
+# last bytes, so the whole file never needs to be read
+def get_file_key(filename):
+    stat = os.stat(filename)
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        digest.update(f.read(FILE_KEY_SAMPLE_SIZE))
+        if stat.st_size > FILE_KEY_SAMPLE_SIZE:
+            f.seek(max(FILE_KEY_SAMPLE_SIZE, stat.st_size - FILE_KEY_SAMPLE_SIZE))
+            digest.update(f.read(FILE_KEY_SAMPLE_SIZE))
+    return str(stat.st_size) + '-' + str(stat.st_mtime_ns) + '-' + digest.hexdigest()
+
+
+# Returns the length of a video file in seconds. If a DB directory is given, the probe cache in the DB is
+# checked first and ffprobe is only run for files which haven't been probed before
+def get_video_length(filename, db_dir=None):
+    if db_dir is None:
+        return probe_video_length(filename)
+
+    file_key = get_file_key(filename)
+    length = db_utils.get_cached_probe_length(file_key, filename, db_dir)
+    if length is None:
+        length = probe_video_length(filename)
+        db_utils.save_cached_probe_length(file_key, filename, length, db_dir)
+    return length
+
+
+def probe_video_length(filename):
     result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
                              "format=duration", "-of",
                              "default=noprint_wrappers=1:nokey=1", filename],
@@ -62,3 +200,36 @@ def get_video_length(filename):
                             stderr=subprocess.STDOUT)
     return float(result.stdout)
 
+
+def get_device_semaphore(file_path, per_device_limit):
+    device = os.stat(file_path).st_dev
+    with _device_semaphores_lock:
+        if device not in _device_semaphores:
+            _device_semaphores[device] = threading.BoundedSemaphore(per_device_limit)
+        return _device_semaphores[device]
+
+
+def get_probe_semaphore(max_workers):
+    global _probe_semaphore
+    with _device_semaphores_lock:
+        if _probe_semaphore is None:
+            _probe_semaphore = threading.BoundedSemaphore(max_workers)
+        return _probe_semaphore
+
+
+""" Probes the lengths of a list of video files using a pool of worker threads, each running ffprobe.
+
+    Yields (file, length) tuples in the order the probes complete. At most max_workers probes run at once,
+    and at most per_device_limit of them read from the same storage device. These limits also hold across
+    several pools running at the same time. If a DB directory is given, the probe cache is used.
+"""
+def probe_video_lengths(files, max_workers, per_device_limit, db_dir=None):
+
+    def probe(file):
+        with get_device_semaphore(file, per_device_limit), get_probe_semaphore(max_workers):
+            return file, get_video_length(file, db_dir)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(probe, file) for file in files]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,159 @@
+from bisect import bisect_right
+from collections import deque
+import random
+
+# Scheduling engine which decides which episodes a channel plays. The engine only works on the inputs it is
+# given, the catalog and chunk plans of each show along with the channel's saved show state, and doesn't
+# access the DB, so schedules can be generated and checked without a DB or any media files.
+#
+# A channel rotates through its shows, playing one chunk of the current show before moving on to the next
+# show. Chunks are played in order, or shuffled if the channel's order is random, and every chunk of a show
+# is played once before any of them are repeated. Once all of a show's chunks have been played the show's
+# chunk offset is incremented, so the next pass over the show splits its episodes at different places.
+#
+# A chunk is identified by the absolute order of its first episode.
+
+
+# The inputs of a single show on a channel
+class ShowChunks:
+
+    """ The chunk plans are a dict of chunk offset to the (start, end) catalog index ranges of the chunks
+        for that offset, and must include every offset the show can move to. The played chunk IDs are the
+        chunks played since the show's chunks were last all played, which are skipped on the first pass.
+    """
+    def __init__(self, series_catalog, chunk_plans, chunk_offset, played_chunk_ids):
+        self.catalog = series_catalog
+        self.chunk_plans = chunk_plans
+        self.chunk_offset = chunk_offset
+        self.played_chunk_ids = played_chunk_ids
+
+
+""" Result of scheduling a time window of a channel.
+
+    The entries are the catalog Episode records to play in order. The chunk offsets are the offsets of every
+    show at the end of the window. The played chunk IDs hold, per show, the chunks played in this window, and
+    the cleared shows are the shows which had all their chunks played in this window, so their previously
+    played chunks should be forgotten before the new ones are saved.
+"""
+class Schedule:
+
+    def __init__(self, entries, start_time, end_time, chunk_offsets, played_chunk_ids, cleared_shows):
+        self.entries = entries
+        self.start_time = start_time
+        self.end_time = end_time
+        self.chunk_offsets = chunk_offsets
+        self.played_chunk_ids = played_chunk_ids
+        self.cleared_shows = cleared_shows
+
+
+""" Schedules the episodes of a channel.
+
+    The scheduler keeps its position between calls to schedule(), so consecutive windows continue from where
+    the previous window ended. The show index is the show the rotation starts with. All of the randomness
+    comes from a random generator seeded with the given seed, so the same inputs and seed always produce the
+    same schedule.
+"""
+class ChannelScheduler:
+
+    def __init__(self, shows, order, segments_per_chunk, seed, show_index=0):
+        self.shows = shows
+        self.is_random = order == 'Random'
+        self.segments_per_chunk = max(segments_per_chunk, 1)
+        self.rng = random.Random(seed)
+        self.show_index = show_index % len(shows) if shows else 0
+        self.chunk_offsets = [show.chunk_offset for show in shows]
+
+        # The chunks of each show which are still to be played in this pass over the show
+        self.remaining_chunks = []
+        for show in shows:
+            ranges = [chunk_range for chunk_range in show.chunk_plans[show.chunk_offset]
+                      if show.catalog.absolute_orders[chunk_range[0]] not in show.played_chunk_ids]
+            self.remaining_chunks.append(self.order_chunks(ranges))
+
+    def order_chunks(self, ranges):
+        ranges = list(ranges)
+        if self.is_random:
+            self.rng.shuffle(ranges)
+        return deque(ranges)
+
+    # Starts a new pass over a show with the next chunk offset
+    def refill_show(self, show_index):
+        show = self.shows[show_index]
+        self.chunk_offsets[show_index] = (self.chunk_offsets[show_index] + 1) % self.segments_per_chunk
+        self.remaining_chunks[show_index] = self.order_chunks(show.chunk_plans[self.chunk_offsets[show_index]])
+
+    # Schedules chunks from the start time until the end time is reached. The last chunk may run past the
+    # end time, so the returned schedule's end time is where the next window should start
+    def schedule(self, start_time, end_time):
+        entries = []
+        played_chunk_ids = [set() for _ in self.shows]
+        cleared_shows = set()
+        curr_time = start_time
+
+        # Number of shows in a row which had no chunks at all, used to stop if no show has any episodes
+        empty_shows = 0
+        while curr_time < end_time and empty_shows < len(self.shows):
+            show_index = self.show_index
+            self.show_index = (self.show_index + 1) % len(self.shows)
+
+            if not self.remaining_chunks[show_index]:
+                self.refill_show(show_index)
+                played_chunk_ids[show_index].clear()
+                cleared_shows.add(show_index)
+                if not self.remaining_chunks[show_index]:
+                    empty_shows += 1
+                    continue
+            empty_shows = 0
+
+            series_catalog = self.shows[show_index].catalog
+            start, end = self.remaining_chunks[show_index].popleft()
+            entries.extend(series_catalog.slice(start, end))
+            played_chunk_ids[show_index].add(series_catalog.absolute_orders[start])
+            curr_time += series_catalog.offsets[end] - series_catalog.offsets[start]
+
+        return Schedule(entries, start_time, curr_time, list(self.chunk_offsets), played_chunk_ids, cleared_shows)
+
+
+""" Time index over the planned schedule of a channel.
+
+    Built from schedule entries of (position, start_time, length, file_path, series_id, absolute_order) in
+    order. The start times are cumulative, so finding what is playing at a given time is a binary search over
+    them rather than a walk over the schedule.
+"""
+class ScheduleIndex:
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.start_times = [entry[1] for entry in entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Time the last entry of the schedule finishes at, or None if the schedule is empty
+    def end_time(self):
+        if not self.entries:
+            return None
+        return self.entries[-1][1] + self.entries[-1][2]
+
+    # Returns the index of the entry playing at the given time along with how many seconds into the entry the
+    # time is, or None if nothing is scheduled at that time
+    def locate(self, timestamp):
+        idx = bisect_right(self.start_times, timestamp) - 1
+        if idx < 0:
+            return None
+        offset = timestamp - self.start_times[idx]
+        if offset >= self.entries[idx][2]:
+            return None
+        return idx, offset
+
+    # Returns the entry playing at the given time, how many seconds into it the time is and the entry after
+    # it. The entries are None if there is nothing scheduled
+    def now_next(self, timestamp):
+        location = self.locate(timestamp)
+        if location is None:
+            idx = bisect_right(self.start_times, timestamp)
+            next_entry = self.entries[idx] if idx < len(self.entries) else None
+            return None, 0, next_entry
+        idx, offset = location
+        next_entry = self.entries[idx + 1] if idx + 1 < len(self.entries) else None
+        return self.entries[idx], offset, next_entry
@@ -0,0 +1,206 @@
+import json
+import os
+import time
+
+import common.file_utils as file_utils
+
+# Telemetry of the channel streams. FFMPEG is started with -progress, which writes a block of key=value lines
+# every progress period, each block ending with a progress= line. The last block of each channel is turned into
+# the channel's metrics, which are exported as a Prometheus text file, for the node exporter's textfile
+# collector, and as a JSON status file.
+#
+# When run by cron the progress is written to a file per channel, which is emptied each time the end of it is
+# read. The daemon reads the progress of its children straight from a pipe.
+
+# Number of seconds between the progress blocks written by FFMPEG
+PROGRESS_PERIOD = 5
+
+# Channels encoding slower than this are falling behind real time and will start buffering
+REALTIME_SPEED = 1.0
+
+# Number of bytes read from the end of a progress file, enough to hold the last complete block
+PROGRESS_TAIL_SIZE = 4096
+
+PROMETHEUS_FILE = 'homebroadcaster.prom'
+STATUS_FILE = 'status.json'
+
+
+# Values FFMPEG doesn't know yet, such as the speed before the first frame, are written as N/A
+def parse_number(value, suffix=''):
+    if value is None:
+        return None
+    value = value.strip()
+    if value.endswith(suffix):
+        value = value[:len(value) - len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_count(value):
+    number = parse_number(value)
+    if number is None:
+        return None
+    return int(number)
+
+
+# Splits FFMPEG's progress output into blocks
+class ProgressParser:
+
+    def __init__(self):
+        self.block = {}
+
+    # Adds a line of progress output and returns the block the line completes, or None
+    def feed(self, line):
+        key, separator, value = line.strip().partition('=')
+        if not separator:
+            return None
+        self.block[key] = value
+        if key != 'progress':
+            return None
+        block = self.block
+        self.block = {}
+        return block
+
+
+# Returns the last complete block of a progress file, or None if there isn't one
+def read_last_progress(progress_path):
+    with open(progress_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        tail_start = max(f.tell() - PROGRESS_TAIL_SIZE, 0)
+        f.seek(tail_start)
+        lines = f.read().decode('utf-8', errors='replace').split('\n')
+
+    # The first line may have been cut off by the seek so it is skipped
+    if tail_start > 0:
+        lines = lines[1:]
+    parser = ProgressParser()
+    last_block = None
+    for line in lines:
+        block = parser.feed(line)
+        if block is not None:
+            last_block = block
+    return last_block
+
+
+""" Metrics of the stream of a single channel.
+
+    The frame counts are those of the channel's current FFMPEG process, so they start over when the stream is
+    restarted, while the restarts are counted over the lifetime of the channel.
+"""
+class ChannelMetrics:
+
+    def __init__(self, channel, restarts=0):
+        self.channel = channel
+        self.running = False
+        self.restarts = restarts
+        self.speed = None
+        self.out_time = None
+        self.bitrate = None
+        self.frame = None
+        self.drop_frames = None
+        self.dup_frames = None
+        # Time the last progress block was received
+        self.progress_time = None
+
+    def update(self, block, progress_time):
+        self.speed = parse_number(block.get('speed'), 'x')
+        # Despite its name, out_time_ms is in microseconds as well
+        out_time_us = parse_number(block.get('out_time_us', block.get('out_time_ms')))
+        self.out_time = out_time_us / 1_000_000 if out_time_us is not None else None
+        self.bitrate = parse_number(block.get('bitrate'), 'kbits/s')
+        self.frame = parse_count(block.get('frame'))
+        self.drop_frames = parse_count(block.get('drop_frames'))
+        self.dup_frames = parse_count(block.get('dup_frames'))
+        self.progress_time = progress_time
+
+    def is_below_realtime(self):
+        return self.running and self.speed is not None and self.speed < REALTIME_SPEED
+
+    def to_dict(self, curr_time):
+        return {
+            'running': self.running,
+            'below_realtime': self.is_below_realtime(),
+            'speed': self.speed,
+            'out_time_seconds': self.out_time,
+            'bitrate_kbps': self.bitrate,
+            'frame': self.frame,
+            'drop_frames': self.drop_frames,
+            'dup_frames': self.dup_frames,
+            'restarts': self.restarts,
+            'progress_age_seconds': self.get_progress_age(curr_time)
+        }
+
+    def get_progress_age(self, curr_time):
+        if self.progress_time is None:
+            return None
+        return round(max(curr_time - self.progress_time, 0), 3)
+
+
+# The exported Prometheus metrics as (name, type, help, function returning the value from the channel's
+# metrics). Channels without a value for a metric are left out of it
+PROMETHEUS_METRICS = [
+    ('homebroadcaster_channel_up', 'gauge', 'Whether the stream of the channel is running',
+     lambda metrics, curr_time: 1 if metrics.running else 0),
+    ('homebroadcaster_channel_below_realtime', 'gauge',
+     'Whether the stream of the channel is encoding slower than real time',
+     lambda metrics, curr_time: 1 if metrics.is_below_realtime() else 0),
+    ('homebroadcaster_channel_speed', 'gauge', 'Encoding speed of the stream relative to real time',
+     lambda metrics, curr_time: metrics.speed),
+    ('homebroadcaster_channel_out_time_seconds', 'gauge', 'Output time of the stream since it was started',
+     lambda metrics, curr_time: metrics.out_time),
+    ('homebroadcaster_channel_bitrate_kbps', 'gauge', 'Output bitrate of the stream in kbit/s',
+     lambda metrics, curr_time: metrics.bitrate),
+    ('homebroadcaster_channel_dropped_frames_total', 'counter', 'Frames dropped since the stream was started',
+     lambda metrics, curr_time: metrics.drop_frames),
+    ('homebroadcaster_channel_duplicated_frames_total', 'counter',
+     'Frames duplicated since the stream was started',
+     lambda metrics, curr_time: metrics.dup_frames),
+    ('homebroadcaster_channel_restarts_total', 'counter', 'Number of times the stream has been restarted',
+     lambda metrics, curr_time: metrics.restarts),
+    ('homebroadcaster_channel_progress_age_seconds', 'gauge', 'Seconds since the stream last reported progress',
+     lambda metrics, curr_time: metrics.get_progress_age(curr_time))
+]
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(channel_metrics, curr_time):
+    lines = []
+    for name, metric_type, description, get_value in PROMETHEUS_METRICS:
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+        for metrics in channel_metrics:
+            value = get_value(metrics, curr_time)
+            if value is None:
+                continue
+            lines.append(name + '{channel="' + escape_label_value(metrics.channel) + '"} ' + repr(value))
+    return '\n'.join(lines) + '\n'
+
+
+# Writes the Prometheus text file and the JSON status file of the given channel metrics to the metrics directory
+def save_metrics(channel_metrics, metrics_dir):
+    curr_time = time.time()
+    status = {
+        'updated_time': curr_time,
+        'channels': {metrics.channel: metrics.to_dict(curr_time) for metrics in channel_metrics}
+    }
+    prometheus_text = render_prometheus(channel_metrics, curr_time)
+    file_utils.write_atomically(metrics_dir + PROMETHEUS_FILE, lambda f: f.write(prometheus_text.encode()))
+    file_utils.write_atomically(metrics_dir + STATUS_FILE, lambda f: f.write(json.dumps(status, indent=2).encode()))
+
+
+# Returns the restart counts of the channels from the last saved status file
+def load_restart_counts(metrics_dir):
+    status_path = metrics_dir + STATUS_FILE
+    if not os.path.exists(status_path):
+        return {}
+    try:
+        with open(status_path) as f:
+            status = json.load(f)
+    except ValueError:
+        return {}
+    return {channel: channel_status.get('restarts', 0) for channel, channel_status in status['channels'].items()}
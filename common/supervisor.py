@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+
+# Supervisor of long-running child processes, used by the daemon mode to own the FFMPEG process of every
+# channel. Each process is watched through its asyncio subprocess handle rather than a pid file, so a process
+# exiting is noticed straight away and a reused pid can never be mistaken for the channel.
+#
+# A process which exits without being stopped is handed back to the app through the restart callback after
+# a delay. The delay doubles each time a process exits again shortly after being started, so a channel which
+# can't stay up doesn't spin.
+
+# Number of seconds waited before restarting a process which exited, and the most it is backed off to
+RESTART_DELAY = 2
+MAX_RESTART_DELAY = 60
+
+# Number of seconds a process has to run for before its restart delay is reset
+STABLE_RUN_TIME = 60
+
+# Number of seconds a stopped process is given to exit before it is killed
+STOP_TIMEOUT = 10
+
+STATE_RUNNING = 'running'
+STATE_RESTARTING = 'restarting'
+STATE_STOPPED = 'stopped'
+
+
+# A supervised process along with the task waiting on it
+class Child:
+
+    def __init__(self, name, command, log_path):
+        self.name = name
+        self.command = command
+        self.log_path = log_path
+        self.process = None
+        self.watch_task = None
+        self.output_task = None
+        self.restart_task = None
+        self.state = STATE_STOPPED
+        self.start_time = 0
+        self.restart_delay = RESTART_DELAY
+
+
+""" Starts, watches and stops named child processes.
+
+    The restart callback is a coroutine function called with the name of a process which exited on its own.
+    It is up to the callback to start the process again, since the command may need to change, for example
+    to resume a channel from where its schedule is at.
+"""
+class Supervisor:
+
+    def __init__(self, restart_callback):
+        self.restart_callback = restart_callback
+        self.children = {}
+
+    def names(self):
+        return list(self.children)
+
+    def get_state(self, name):
+        child = self.children.get(name)
+        if child is None:
+            return None
+        return child.state
+
+    def is_running(self, name):
+        return self.get_state(name) == STATE_RUNNING
+
+    # Starts the process of the given name, replacing the process if it is already running. The error output
+    # of the process goes to the log file. If an output callback is given, it is called with the name of the
+    # process and each line the process writes to its standard output, otherwise the output is discarded
+    async def start(self, name, command, log_path, output_callback=None):
+        child = self.children.get(name)
+        if child is None:
+            child = Child(name, command, log_path)
+            self.children[name] = child
+        else:
+            # A pending restart sees the new state and is dropped
+            child.state = STATE_STOPPED
+            await self.terminate(child)
+        child.command = command
+        child.log_path = log_path
+
+        stdout = subprocess.PIPE if output_callback is not None else subprocess.DEVNULL
+        with open(log_path, 'w') as log_file:
+            child.process = await asyncio.create_subprocess_exec(*command, stdin=subprocess.DEVNULL,
+                                                                 stdout=stdout, stderr=log_file)
+        child.state = STATE_RUNNING
+        child.start_time = time.monotonic()
+        child.watch_task = asyncio.ensure_future(self.watch(child, child.process))
+        if output_callback is not None:
+            child.output_task = asyncio.ensure_future(self.read_output(name, child.process, output_callback))
+        logging.debug('Started ' + name + ' with pid ' + str(child.process.pid))
+
+    # Returns the pid of the process of the given name, or None if it has no process
+    def get_pid(self, name):
+        child = self.children.get(name)
+        if child is None or child.process is None:
+            return None
+        return child.process.pid
+
+    # Stops the process of the given name and forgets it
+    async def stop(self, name):
+        child = self.children.pop(name, None)
+        if child is None:
+            return
+
+        child.state = STATE_STOPPED
+        if child.restart_task is not None:
+            child.restart_task.cancel()
+        await self.terminate(child)
+
+    # Asks the process of a child to exit and kills it if it hasn't done so within the stop timeout
+    async def terminate(self, child):
+        process = child.process
+        if process is None or process.returncode is not None:
+            return
+
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(child.name + ' did not exit after ' + str(STOP_TIMEOUT) + ' seconds, killing it')
+            process.kill()
+            await process.wait()
+        logging.debug('Stopped ' + child.name)
+
+    async def stop_all(self):
+        await asyncio.gather(*[self.stop(name) for name in list(self.children)])
+
+    async def read_output(self, name, process, output_callback):
+        async for line in process.stdout:
+            try:
+                output_callback(name, line.decode('utf-8', errors='replace'))
+            except Exception:
+                logging.exception('Error handling the output of ' + name)
+
+    # Waits for a process to exit and schedules its restart unless it was stopped on purpose
+    async def watch(self, child, process):
+        return_code = await process.wait()
+        if child.state != STATE_RUNNING or child.process is not process:
+            return
+
+        run_time = time.monotonic() - child.start_time
+        if run_time >= STABLE_RUN_TIME:
+            child.restart_delay = RESTART_DELAY
+        logging.warning(child.name + ' exited with code ' + str(return_code) + ' after ' + str(int(run_time)) +
+                        ' seconds, restarting in ' + str(child.restart_delay) + ' seconds')
+
+        child.state = STATE_RESTARTING
+        child.restart_task = asyncio.ensure_future(self.restart(child, child.restart_delay))
+        child.restart_delay = min(child.restart_delay * 2, MAX_RESTART_DELAY)
+
+    async def restart(self, child, delay):
+        await asyncio.sleep(delay)
+        if self.children.get(child.name) is not child or child.state != STATE_RESTARTING:
+            return
+        try:
+            await self.restart_callback(child.name)
+        except Exception:
+            logging.exception('Unable to restart ' + child.name)
+            if self.children.get(child.name) is child and child.state == STATE_RESTARTING:
+                child.restart_task = asyncio.ensure_future(self.restart(child, child.restart_delay))
+                child.restart_delay = min(child.restart_delay * 2, MAX_RESTART_DELAY)
+
+
+# Returns the arguments of the command a process is running, or None if the process isn't running. The
+# arguments are read from /proc where there is one and from ps otherwise
+def get_process_arguments(pid):
+    if os.path.isdir('/proc'):
+        try:
+            with open('/proc/' + str(int(pid)) + '/cmdline', 'rb') as cmdline_file:
+                cmdline = cmdline_file.read()
+        except (OSError, ValueError):
+            return None
+        if not cmdline:
+            # Zombie processes have no command line
+            return None
+        return [os.fsdecode(argument) for argument in cmdline.rstrip(b'\0').split(b'\0')]
+
+    try:
+        output = subprocess.run(['ps', '-o', 'args=', '-p', str(int(pid))], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL).stdout
+    except (OSError, ValueError):
+        return None
+    if not output.strip():
+        return None
+    return os.fsdecode(output).split()
+
+
+""" Returns whether the process of a pid is running the given program with the given last argument.
+
+    A pid in a pid file left by a previous run may have been reused by an unrelated process since, so the
+    process is only taken to be the one which was started if its command still matches. The program is
+    looked for in the first two arguments, since the command of a script starts with its interpreter.
+"""
+def is_process_running(pid, program_name, last_argument):
+    arguments = get_process_arguments(pid)
+    if not arguments or arguments[-1] != last_argument:
+        return False
+    return any(os.path.basename(argument) == program_name for argument in arguments[:2])
+
+
+# Stops a process left running by a previous run, given its pid file, and removes the pid file. The process is
+# only stopped if it is still running the given program with the given last argument. Returns whether the
+# process was still running
+def stop_pid_file_process(pid_file_path, program_name, last_argument):
+    with open(pid_file_path) as pid_file:
+        pid = pid_file.readline().strip()
+    os.remove(pid_file_path)
+
+    if not is_process_running(pid, program_name, last_argument):
+        return False
+    try:
+        os.kill(int(pid), signal.SIGTERM)
+    except OSError:
+        return False
+    return True
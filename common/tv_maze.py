@@ -1,20 +1,185 @@
+import collections
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+import common.file_utils as file_utils
 
 tvmaze_api_url = 'http://api.tvmaze.com'
 
-show_single_search_path = '/singlesearch/shows?q='
+show_single_search_path = '/singlesearch/shows'
 show_episode_list_path = '/shows/{series_id}/episodes'
 
+# Default number of seconds a cached response is used without checking with TV Maze if it has changed
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+# Seconds to wait for TV Maze to respond before giving up on a request
+REQUEST_TIMEOUT = 30
+
+# Number of attempts made for a request which is rate limited or fails to connect
+MAX_ATTEMPTS = 5
+
+# Seconds to wait before retrying when TV Maze doesn't send a Retry-After header. Doubled after each attempt
+RETRY_BACKOFF = 2
+
+# TV Maze allows at least 20 calls every 10 seconds per IP address
+RATE_LIMIT_CALLS = 20
+RATE_LIMIT_PERIOD = 10
+
+
+# Limits the number of requests sent within a rolling period across all threads
+class RateLimiter:
+
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self.sent_times = collections.deque()
+        self.lock = threading.Lock()
+
+    # Blocks until another request can be sent without exceeding the limit
+    def acquire(self):
+        while True:
+            with self.lock:
+                curr_time = time.monotonic()
+                while self.sent_times and curr_time - self.sent_times[0] >= self.period:
+                    self.sent_times.popleft()
+                if len(self.sent_times) < self.calls:
+                    self.sent_times.append(curr_time)
+                    return
+                wait_time = self.period - (curr_time - self.sent_times[0])
+            time.sleep(wait_time)
+
+
+_rate_limiter = RateLimiter(RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD)
+
+# The client settings used by the module level functions. Set through configure()
+_settings = {
+    'api_url': tvmaze_api_url,
+    'cache_dir': None,
+    'cache_ttl': DEFAULT_CACHE_TTL
+}
+_session = None
+_session_lock = threading.Lock()
+
+
+""" Sets up the TV Maze client.
+
+    api_url can point the client at a different server, such as a local stub server for testing. If a
+    cache directory is given, responses are saved there and reused until the TTL expires, after which
+    they are revalidated with a conditional request.
+"""
+def configure(api_url=None, cache_dir=None, cache_ttl=None):
+    if api_url is not None:
+        _settings['api_url'] = api_url.rstrip('/')
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _settings['cache_dir'] = cache_dir
+    if cache_ttl is not None:
+        _settings['cache_ttl'] = cache_ttl
+
+
+# Returns the session shared by all requests so connections to TV Maze are pooled and reused
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_cache_path(url):
+    return os.path.join(_settings['cache_dir'], hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+
+def load_cached_response(url):
+    if _settings['cache_dir'] is None:
+        return None
+    try:
+        with open(get_cache_path(url)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached_response(url, cached):
+    if _settings['cache_dir'] is None:
+        return
+    cached_text = json.dumps(cached)
+    file_utils.write_atomically(get_cache_path(url), lambda f: f.write(cached_text.encode()))
+
+
+# Sends a GET request, retrying with backoff when rate limited (HTTP 429) or when the connection fails.
+# Requests from all threads share the same rate limit
+def send_request(url, params, headers):
+    backoff = RETRY_BACKOFF
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        _rate_limiter.acquire()
+        try:
+            resp = get_session().get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.ConnectionError:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logging.warning('Unable to connect to TV Maze, retrying in ' + str(backoff) + ' seconds')
+            time.sleep(backoff)
+            backoff *= 2
+            continue
+
+        if resp.status_code != 429 or attempt == MAX_ATTEMPTS:
+            return resp
+
+        retry_after = resp.headers.get('Retry-After')
+        wait_time = int(retry_after) if retry_after is not None and retry_after.isdigit() else backoff
+        logging.debug('TV Maze rate limit reached, retrying in ' + str(wait_time) + ' seconds')
+        time.sleep(wait_time)
+        backoff *= 2
+
+
+# Retrieves the JSON response for an API path, using the response cache if one is configured
+def get_json(path, params=None):
+    url = _settings['api_url'] + path
+    cache_key = url
+    if params:
+        cache_key = url + '?' + '&'.join(key + '=' + str(params[key]) for key in sorted(params))
+
+    cached = load_cached_response(cache_key)
+    if cached is not None and time.time() - cached['fetched'] < _settings['cache_ttl']:
+        return cached['body']
+
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    resp = send_request(url, params, headers)
+    if resp.status_code == 304 and cached is not None:
+        cached['fetched'] = time.time()
+        save_cached_response(cache_key, cached)
+        return cached['body']
+
+    resp.raise_for_status()
+    body = resp.json()
+    save_cached_response(cache_key, {
+        'fetched': time.time(),
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+        'body': body
+    })
+    return body
+
 
 def show_single_search(name):
-    resp = requests.get(tvmaze_api_url + show_single_search_path + name)
-    json_response = json.loads(json.dumps(resp.json()))
-    return json_response
+    return get_json(show_single_search_path, {'q': name})
 
 
 def show_episode_list(show_id):
-    resp = requests.get(tvmaze_api_url + show_episode_list_path.replace('{series_id}', str(show_id)))
-    json_response = json.loads(json.dumps(resp.json()))
-    return json_response
-
+    return get_json(show_episode_list_path.replace('{series_id}', str(show_id)))
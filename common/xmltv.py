@@ -1,8 +1,9 @@
-from datetime import datetime, date
+from bisect import bisect_left, bisect_right
+import calendar
 from dateutil.parser import parse
 import time
 import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import ElementTree, Element
+from xml.etree.ElementTree import Element
 
 # IMPORTANT NOTE: The XML TV file generated by this module doesn't include the XML TV
 # standard specified header lines so the output technically isn't fully complaint.
@@ -10,43 +11,170 @@ from xml.etree.ElementTree import ElementTree, Element
 # will be kept as is.
 
 
-def generate_new_xmltv():
-    return Element('tv')
+# The programmes of a single channel kept sorted by start time
+class ChannelProgrammes:
+
+    def __init__(self):
+        self.start_times = []
+        self.stop_times = []
+        self.nodes = []
+        # Whether the stop times are in order as well, which is the case unless programmes overlap
+        self.stops_sorted = True
+
+    def add(self, programme_node):
+        start_time = parse_time(programme_node.attrib['start'])
+        stop_time = parse_time(programme_node.attrib['stop'])
+        # Programmes are almost always added in order so appending is the common case
+        if not self.start_times or start_time >= self.start_times[-1]:
+            idx = len(self.start_times)
+        else:
+            idx = bisect_right(self.start_times, start_time)
+        self.start_times.insert(idx, start_time)
+        self.stop_times.insert(idx, stop_time)
+        self.nodes.insert(idx, programme_node)
+        if ((idx > 0 and self.stop_times[idx - 1] > stop_time) or
+                (idx + 1 < len(self.stop_times) and stop_time > self.stop_times[idx + 1])):
+            self.stops_sorted = False
+
+    # Removes the programmes which stopped before the given time
+    def remove_ended(self, curr_time):
+        if self.stops_sorted:
+            cutoff = bisect_left(self.stop_times, curr_time)
+            del self.start_times[:cutoff]
+            del self.stop_times[:cutoff]
+            del self.nodes[:cutoff]
+            return
+
+        kept = [idx for idx, stop_time in enumerate(self.stop_times) if stop_time >= curr_time]
+        self.start_times = [self.start_times[idx] for idx in kept]
+        self.stop_times = [self.stop_times[idx] for idx in kept]
+        self.nodes = [self.nodes[idx] for idx in kept]
+        self.stops_sorted = all(self.stop_times[idx] <= self.stop_times[idx + 1]
+                                for idx in range(len(self.stop_times) - 1))
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+""" TV guide model indexed by channel ID.
+
+    Each channel's programmes are kept in their own list sorted by start time, so the programmes of a
+    channel can be removed or replaced without looking at the programmes of any other channel. The guide
+    serializes to the same XMLTV document as a flat tree: the channel nodes followed by the programmes.
+"""
+class Guide:
+
+    def __init__(self):
+        self.attrib = {}
+        # Channel ID to channel node, in reverse of the order the channels are written in since new
+        # channels are written first
+        self.channels = {}
+        # Channel ID to the ChannelProgrammes of the channel
+        self.programmes = {}
+
+    def add_channel_node(self, channel_node):
+        self.channels[channel_node.attrib['id']] = channel_node
+
+    def add_programme_node(self, programme_node):
+        self.get_channel_programmes(programme_node.attrib['channel']).add(programme_node)
+
+    def get_channel_programmes(self, channel_id):
+        if channel_id not in self.programmes:
+            self.programmes[channel_id] = ChannelProgrammes()
+        return self.programmes[channel_id]
+
+    """ Yields the serialized XMLTV document piece by piece, so the whole document never has to be held
+        in memory at once. The output is the same as writing the guide as a single tree with ElementTree.
+    """
+    def iter_serialized(self):
+        yield serialize_root_start(self.attrib)
+        for channel_node in reversed(self.channels.values()):
+            yield serialize_node(channel_node)
+        for channel_programmes in self.programmes.values():
+            for programme_node in channel_programmes.nodes:
+                yield serialize_node(programme_node)
+        yield ROOT_END
+
 
+ROOT_END = b'</tv>'
 
-def open_xmltv(xmltv_path):
-    tree = ET.parse(xmltv_path)
-    return tree.getroot()
 
+def serialize_node(node):
+    return ET.tostring(node, encoding='us-ascii')
 
-# This function removes all programme nodes where the stop time is before the current time
+
+# Returns the start tag of the root node of an XMLTV document
+def serialize_root_start(attrib):
+    # Serialize an empty root to get its start tag with the attributes escaped, then drop the ' />'
+    return serialize_node(Element('tv', attrib))[:-3] + b'>'
+
+
+""" Converts an XMLTV time to a Unix timestamp.
+
+    Times in the '%Y%m%d%H%M%S %z' format written by this app are converted directly from the digits, which
+    is many times faster than dateutil. Any other format, such as from a guide written by another tool, falls
+    back to dateutil's fuzzy parsing.
+"""
+def parse_time(time_string):
+    if (len(time_string) == 20 and time_string[14] == ' ' and time_string[15] in '+-' and
+            time_string[:14].isdigit() and time_string[16:].isdigit()):
+        timestamp = calendar.timegm((int(time_string[0:4]), int(time_string[4:6]), int(time_string[6:8]),
+                                     int(time_string[8:10]), int(time_string[10:12]), int(time_string[12:14])))
+        offset = int(time_string[16:18]) * 3600 + int(time_string[18:20]) * 60
+        if time_string[15] == '-':
+            offset = -offset
+        return timestamp - offset
+    return parse(time_string, fuzzy=True).timestamp()
+
+
+def generate_new_xmltv():
+    return Guide()
+
+
+""" Reads an XMLTV file into a guide one top level node at a time. Each channel or programme node is
+    detached from the document as soon as it has been read, so the document itself is never held in memory
+    on top of the guide. If a cutoff time is given, programmes which stopped before it are dropped as they are
+    read instead of being added to the guide.
+"""
+def open_xmltv(xmltv_path, cutoff_time=None):
+    guide = Guide()
+    depth = 0
+    root = None
+    for event, node in ET.iterparse(xmltv_path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = node
+                guide.attrib = dict(root.attrib)
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 1:
+            continue
+        if node.tag == 'channel':
+            guide.add_channel_node(node)
+        elif node.tag == 'programme':
+            if cutoff_time is None or parse_time(node.attrib['stop']) >= cutoff_time:
+                guide.add_programme_node(node)
+        root.remove(node)
+
+    # Channels are written newest first but kept in the guide in the order they were added
+    guide.channels = dict(reversed(list(guide.channels.items())))
+    return guide
+
+
+# This function removes all programme nodes where the stop time is before the current time. Use it for
+# guides which are already in memory, guides being read are pruned by passing the time to open_xmltv
 def remove_past_programmes(root):
-    children_to_remove = []
-    for child in root:
-        if child.tag == 'programme':
-            stop_time = parse(child.attrib['stop'], fuzzy=True).timestamp()
-            curr_time = int(time.time())
-            if curr_time > stop_time:
-                children_to_remove.append(child)
-    for child in children_to_remove:
-        root.remove(child)
-
-
-def remove_channel_programmes(channel, root):
-    children_to_remove = []
-    for child in root:
-        if (child.tag == 'programme' and
-                child.attrib['channel'] == (channel + '.tv')):
-            children_to_remove.append(child)
-    for child in children_to_remove:
-        root.remove(child)
+    curr_time = int(time.time())
+    for channel_programmes in root.programmes.values():
+        channel_programmes.remove_ended(curr_time)
 
 
 def add_channel_if_not_exists(root, channel):
-    for node in root.findall('channel'):
-        if node.attrib['id'] == channel + '.tv':
-            # Element already exists for the channel
-            return
+    if channel + '.tv' in root.channels:
+        # Element already exists for the channel
+        return
 
     channel_node = Element('channel')
     channel_node.attrib['id'] = channel + '.tv'
@@ -54,16 +182,7 @@ def add_channel_if_not_exists(root, channel):
     display_node.attrib['lang'] = 'en'
     display_node.text = channel + '.tv'
     channel_node.append(display_node)
-    root.insert(0, channel_node)
-
-
-def remove_channel(channel, root):
-    channel_node = None
-    for node in root.findall('channel'):
-        if node.attrib['id'] == channel + '.tv':
-            channel_node = node
-            break
-    root.remove(channel_node)
+    root.add_channel_node(channel_node)
 
 
 def add_programme(root, channel, start_time, stop_time, title, subtitle, desc):
@@ -87,8 +206,4 @@ def add_programme(root, channel, start_time, stop_time, title, subtitle, desc):
     desc_node.text = desc
     programme_node.append(desc_node)
 
-    root.append(programme_node)
-
-
-def save_to_file(root, file_path):
-    ElementTree(root).write(file_path)
+    root.add_programme_node(programme_node)
@@ -0,0 +1,221 @@
+import gzip
+import json
+import os
+import time
+import urllib.parse
+
+import common.file_utils as file_utils
+import common.xmltv as xmltv
+
+# The programmes of each channel are kept in their own shard file, which is a complete XMLTV document
+# holding the channel node followed by the channel's programmes. Restarting a channel only rewrites the
+# shard of that channel.
+#
+# The published XMLTV file, along with a gzipped copy of it for clients which accept compressed guides,
+# is built by concatenating the shards. A manifest records the byte range of the channel node and of the
+# programmes within each shard, so the merge copies bytes straight out of the shards without parsing them.
+
+MANIFEST_FILE = 'manifest.json'
+
+# Number of seconds a programme may be over before its shard is rewritten to remove it. Past programmes are
+# harmless to clients so shards are only pruned once in a while rather than on every run
+SHARD_PRUNE_GRACE_PERIOD = 6 * 60 * 60
+
+COPY_BLOCK_SIZE = 1024 * 1024
+GZIP_COMPRESS_LEVEL = 6
+
+
+# Reads an XMLTV file into a guide without the programmes which have already ended
+def open_guide(xmltv_path):
+    return xmltv.open_xmltv(xmltv_path, int(time.time()))
+
+
+""" Set of per channel guide shards along with the manifest describing them.
+
+    The shards are kept in the order the channels are written to the merged guide, which is newest channel
+    first. Each shard is described by a dict of its file name, size, modification time, the byte ranges of
+    the channel node and the programmes in the file and the earliest stop time of its programmes.
+"""
+class GuideShards:
+
+    def __init__(self, shard_dir, attrib=None, shards=None, is_modified=False):
+        self.shard_dir = shard_dir
+        self.attrib = attrib if attrib is not None else {}
+        # Channel ID to the description of the channel's shard
+        self.shards = shards if shards is not None else {}
+        # Whether the shards have changed since the merged guide was last written
+        self.is_modified = is_modified
+
+    # Loads the shards from the shard directory. If there are no shards yet but there is an XMLTV file from
+    # before guides were sharded, the XMLTV file is split into shards
+    @classmethod
+    def load(cls, shard_dir, legacy_xmltv_path=None):
+        if not os.path.exists(shard_dir):
+            os.mkdir(shard_dir)
+
+        manifest_path = shard_dir + MANIFEST_FILE
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            shards = {shard['channel_id']: shard for shard in manifest['shards']}
+            return cls(shard_dir, manifest['attrib'], shards, manifest['merge_pending'])
+
+        guide_shards = cls(shard_dir, is_modified=True)
+        if legacy_xmltv_path is not None and os.path.exists(legacy_xmltv_path):
+            guide = open_guide(legacy_xmltv_path)
+            guide_shards.attrib = guide.attrib
+            channel_ids = list(reversed(guide.channels))
+            channel_ids.extend(channel_id for channel_id in guide.programmes if channel_id not in guide.channels)
+            for channel_id in channel_ids:
+                guide_shards.shards[channel_id] = guide_shards.write_shard(channel_id, guide)
+        guide_shards.save_manifest()
+        return guide_shards
+
+    def get_shard_path(self, channel_id):
+        return self.shard_dir + urllib.parse.quote(channel_id, safe='') + '.xml'
+
+    # Writes the shard of a channel from the channel's node and programmes in the given guide and returns
+    # the description of the shard
+    def write_shard(self, channel_id, guide):
+        channel_node = guide.channels.get(channel_id)
+        channel_programmes = guide.programmes.get(channel_id)
+        programme_nodes = channel_programmes.nodes if channel_programmes is not None else []
+        shard = {
+            'channel_id': channel_id,
+            'file_name': os.path.basename(self.get_shard_path(channel_id)),
+            'first_stop': min(channel_programmes.stop_times) if programme_nodes else None
+        }
+
+        def write_function(f):
+            f.write(xmltv.serialize_root_start({}))
+            channel_start = f.tell()
+            if channel_node is not None:
+                f.write(xmltv.serialize_node(channel_node))
+            programmes_start = f.tell()
+            for programme_node in programme_nodes:
+                f.write(xmltv.serialize_node(programme_node))
+            shard['channel_range'] = [channel_start, programmes_start]
+            shard['programmes_range'] = [programmes_start, f.tell()]
+            f.write(xmltv.ROOT_END)
+
+        shard_path = self.get_shard_path(channel_id)
+        file_utils.write_atomically(shard_path, write_function)
+        stat = os.stat(shard_path)
+        shard['size'] = stat.st_size
+        shard['mtime_ns'] = stat.st_mtime_ns
+        return shard
+
+    # Adds shards written by write_shard, which only touches the channel's own file and so can be called for
+    # several channels at once, to the set and saves the manifest once
+    def put_shards(self, shards):
+        if not shards:
+            return
+        for channel_id, shard in shards.items():
+            if channel_id in self.shards:
+                self.shards[channel_id] = shard
+            else:
+                # New channels are written first
+                self.shards = {channel_id: shard, **self.shards}
+        self.is_modified = True
+        self.save_manifest()
+
+    # Loads the guide of a channel from its shard. A new guide is returned if the channel has no shard
+    def load_channel_guide(self, channel):
+        shard = self.shards.get(channel + '.tv')
+        if shard is None or not os.path.exists(self.shard_dir + shard['file_name']):
+            return xmltv.generate_new_xmltv()
+        return open_guide(self.shard_dir + shard['file_name'])
+
+    def remove_channel(self, channel):
+        channel_id = channel + '.tv'
+        shard = self.shards.pop(channel_id, None)
+        if shard is None:
+            return
+
+        shard_path = self.shard_dir + shard['file_name']
+        if os.path.exists(shard_path):
+            os.remove(shard_path)
+        self.is_modified = True
+        self.save_manifest()
+
+    # Rewrites the shard of a channel from the file itself, dropping any past programmes
+    def reload_shard(self, channel_id):
+        guide = open_guide(self.shard_dir + self.shards[channel_id]['file_name'])
+        self.shards[channel_id] = self.write_shard(channel_id, guide)
+        self.is_modified = True
+
+    # Rewrites the shards which have had programmes end more than the grace period ago
+    def remove_past_programmes(self, grace_period=SHARD_PRUNE_GRACE_PERIOD):
+        cutoff_time = int(time.time()) - grace_period
+        for channel_id, shard in list(self.shards.items()):
+            if shard['first_stop'] is not None and shard['first_stop'] < cutoff_time:
+                self.reload_shard(channel_id)
+        self.save_manifest()
+
+    # Checks that each shard still matches the manifest. Missing shards are dropped and shards which were
+    # changed outside of this module are parsed and rewritten to get their byte ranges
+    def verify_shards(self):
+        for channel_id, shard in list(self.shards.items()):
+            shard_path = self.shard_dir + shard['file_name']
+            if not os.path.exists(shard_path):
+                del self.shards[channel_id]
+                self.is_modified = True
+                continue
+            stat = os.stat(shard_path)
+            if stat.st_size != shard['size'] or stat.st_mtime_ns != shard['mtime_ns']:
+                self.reload_shard(channel_id)
+
+    """ Writes the merged XMLTV file and its gzipped copy, xmltv_path + '.gz', if any shard has changed
+        since they were last written. Both files are streamed from the shards a block at a time and
+        replace the previous files atomically.
+
+        Once any shard has changed every shard is copied again, since the gzipped copy has to be compressed
+        as a whole. The shards are copied as bytes without being parsed, so the cost of a merge is reading
+        and compressing the guide rather than building it.
+    """
+    def merge_to_file(self, xmltv_path):
+        gzip_path = xmltv_path + '.gz'
+        self.verify_shards()
+        if not self.is_modified and os.path.exists(xmltv_path) and os.path.exists(gzip_path):
+            return
+
+        shards = list(self.shards.values())
+
+        def write_merged(out_file, gzip_file):
+            def write(data):
+                out_file.write(data)
+                gzip_file.write(data)
+
+            write(xmltv.serialize_root_start(self.attrib))
+            for range_key in ('channel_range', 'programmes_range'):
+                for shard in shards:
+                    start, end = shard[range_key]
+                    with open(self.shard_dir + shard['file_name'], 'rb') as shard_file:
+                        shard_file.seek(start)
+                        remaining = end - start
+                        while remaining > 0:
+                            data = shard_file.read(min(COPY_BLOCK_SIZE, remaining))
+                            if not data:
+                                break
+                            write(data)
+                            remaining -= len(data)
+            write(xmltv.ROOT_END)
+
+        def write_xmltv(out_file):
+            def write_gzip(gzip_out_file):
+                with gzip.GzipFile(filename='', mode='wb', fileobj=gzip_out_file,
+                                   compresslevel=GZIP_COMPRESS_LEVEL, mtime=0) as gzip_file:
+                    write_merged(out_file, gzip_file)
+            file_utils.write_atomically(gzip_path, write_gzip)
+
+        file_utils.write_atomically(xmltv_path, write_xmltv)
+        self.is_modified = False
+        self.save_manifest()
+
+    def save_manifest(self):
+        manifest = {
+            'attrib': self.attrib,
+            'merge_pending': self.is_modified,
+            'shards': list(self.shards.values())
+        }
+        file_utils.write_atomically(self.shard_dir + MANIFEST_FILE, lambda f: f.write(json.dumps(manifest).encode()))
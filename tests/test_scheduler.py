@@ -0,0 +1,137 @@
+import random
+
+from common import catalog, chunking, scheduler
+
+SEGMENT_RUNTIMES = [600, 1200, 1800]
+EPISODE_LENGTHS = [300, 600, 1320, 1400, 2700]
+
+
+def make_catalog(series_id, episode_count, rng):
+    rows = [(idx, 1, idx + 1, 'Episode ' + str(idx + 1), 'Subtitle', rng.choice(EPISODE_LENGTHS), '/media/' + str(idx))
+            for idx in range(episode_count)]
+    return catalog.Catalog.from_rows(series_id, rows, None)
+
+
+def make_chunk_plans(series_catalog, segments_per_chunk, segment_runtime):
+    return {chunk_offset: chunking.chunk_ranges(series_catalog.lengths, chunk_offset, segments_per_chunk,
+                                                segment_runtime)
+            for chunk_offset in range(segments_per_chunk)}
+
+
+""" The playlist loop the app ran before scheduling was moved into ChannelScheduler, working on catalog index
+    ranges instead of episodes read from the DB. Returns the (series ID, absolute order) of each scheduled
+    episode along with the chunk offsets, played chunk IDs and cleared shows at the end of the schedule.
+"""
+def schedule_with_old_loop(catalogs, chunk_plans, chunk_offsets, played_chunk_ids, order, segments_per_chunk, rng,
+                           start_time, end_time):
+    chunk_offsets = list(chunk_offsets)
+    chunked_shows = [[chunk for chunk in chunk_plans[idx][chunk_offsets[idx]]
+                      if catalogs[idx].absolute_orders[chunk[0]] not in played_chunk_ids[idx]]
+                     for idx in range(len(catalogs))]
+    if order == 'Random':
+        for show_chunks in chunked_shows:
+            rng.shuffle(show_chunks)
+
+    added_chunk_ids = [set() for _ in catalogs]
+    cleared_shows = set()
+    current_show_index = 0
+    current_timestamp = start_time
+    playlist = []
+    while current_timestamp < end_time:
+        if not chunked_shows[current_show_index]:
+            chunk_offsets[current_show_index] = (chunk_offsets[current_show_index] + 1) % segments_per_chunk
+            chunked_shows[current_show_index] = list(chunk_plans[current_show_index][chunk_offsets[current_show_index]])
+            if order == 'Random':
+                rng.shuffle(chunked_shows[current_show_index])
+            added_chunk_ids[current_show_index].clear()
+            cleared_shows.add(current_show_index)
+
+        series_catalog = catalogs[current_show_index]
+        start, end = chunked_shows[current_show_index][0]
+        playlist.extend((series_catalog.series_id, series_catalog.absolute_orders[idx]) for idx in range(start, end))
+        added_chunk_ids[current_show_index].add(series_catalog.absolute_orders[start])
+        current_timestamp += sum(series_catalog.lengths[start:end])
+        del chunked_shows[current_show_index][0]
+
+        current_show_index = (current_show_index + 1) % len(catalogs)
+
+    return playlist, chunk_offsets, added_chunk_ids, cleared_shows
+
+
+def make_channel(rng, show_count, segments_per_chunk, segment_runtime):
+    catalogs = [make_catalog(series_id, rng.randint(1, 60), rng) for series_id in range(show_count)]
+    chunk_plans = [make_chunk_plans(series_catalog, segments_per_chunk, segment_runtime) for series_catalog in catalogs]
+    chunk_offsets = [rng.randrange(segments_per_chunk) for _ in catalogs]
+    played_chunk_ids = [set(rng.sample(range(len(series_catalog)), rng.randint(0, len(series_catalog) // 2)))
+                        for series_catalog in catalogs]
+    return catalogs, chunk_plans, chunk_offsets, played_chunk_ids
+
+
+def make_scheduler(catalogs, chunk_plans, chunk_offsets, played_chunk_ids, order, segments_per_chunk, seed):
+    shows = [scheduler.ShowChunks(series_catalog, show_chunk_plans, chunk_offset, show_played_chunk_ids)
+             for series_catalog, show_chunk_plans, chunk_offset, show_played_chunk_ids
+             in zip(catalogs, chunk_plans, chunk_offsets, played_chunk_ids)]
+    return scheduler.ChannelScheduler(shows, order, segments_per_chunk, seed)
+
+
+def test_schedule_matches_old_loop():
+    rng = random.Random(0)
+    for trial in range(300):
+        segments_per_chunk = rng.randint(1, 4)
+        order = rng.choice(['Random', 'Ordered'])
+        catalogs, chunk_plans, chunk_offsets, played_chunk_ids = make_channel(
+            rng, rng.randint(1, 5), segments_per_chunk, rng.choice(SEGMENT_RUNTIMES))
+        seed = 'trial-' + str(trial)
+        end_time = rng.randint(1, 400000)
+
+        playlist, new_chunk_offsets, added_chunk_ids, cleared_shows = schedule_with_old_loop(
+            catalogs, chunk_plans, chunk_offsets, played_chunk_ids, order, segments_per_chunk, random.Random(seed),
+            0, end_time)
+        schedule = make_scheduler(catalogs, chunk_plans, chunk_offsets, played_chunk_ids, order, segments_per_chunk,
+                                  seed).schedule(0, end_time)
+
+        assert [(entry.series_id, entry.absolute_order) for entry in schedule.entries] == playlist, trial
+        assert schedule.chunk_offsets == new_chunk_offsets, trial
+        assert schedule.played_chunk_ids == added_chunk_ids, trial
+        assert schedule.cleared_shows == cleared_shows, trial
+
+
+def test_schedule_is_reproducible_with_the_same_seed():
+    catalogs, chunk_plans, chunk_offsets, played_chunk_ids = make_channel(random.Random(1), 4, 3, 1800)
+
+    schedules = []
+    for _ in range(2):
+        channel_scheduler = make_scheduler(catalogs, chunk_plans, chunk_offsets, played_chunk_ids, 'Random', 3, 'seed')
+        # Consecutive windows continue from where the previous window ended
+        first_window = channel_scheduler.schedule(0, 86400)
+        second_window = channel_scheduler.schedule(first_window.end_time, 3 * 86400)
+        schedules.append([(entry.series_id, entry.absolute_order)
+                          for entry in first_window.entries + second_window.entries])
+
+    assert schedules[0] == schedules[1]
+    other_seed = make_scheduler(catalogs, chunk_plans, chunk_offsets, played_chunk_ids, 'Random', 3, 'other seed')
+    assert [(entry.series_id, entry.absolute_order) for entry in other_seed.schedule(0, 3 * 86400).entries] != \
+        schedules[0]
+
+
+def test_shows_without_episodes_are_skipped():
+    rng = random.Random(2)
+    catalogs = [make_catalog(0, 0, rng), make_catalog(1, 10, rng), make_catalog(2, 0, rng)]
+    chunk_plans = [make_chunk_plans(series_catalog, 2, 1800) for series_catalog in catalogs]
+    channel_scheduler = make_scheduler(catalogs, chunk_plans, [0, 0, 0], [set(), set(), set()], 'Ordered', 2, 'seed')
+
+    schedule = channel_scheduler.schedule(0, 86400)
+    assert schedule.entries
+    assert {entry.series_id for entry in schedule.entries} == {1}
+    assert schedule.end_time >= 86400
+
+
+def test_channel_without_any_episodes_schedules_nothing():
+    rng = random.Random(3)
+    catalogs = [make_catalog(0, 0, rng), make_catalog(1, 0, rng)]
+    chunk_plans = [make_chunk_plans(series_catalog, 2, 1800) for series_catalog in catalogs]
+    channel_scheduler = make_scheduler(catalogs, chunk_plans, [0, 0], [set(), set()], 'Random', 2, 'seed')
+
+    schedule = channel_scheduler.schedule(0, 86400)
+    assert schedule.entries == []
+    assert schedule.end_time == 0